@@ -0,0 +1,653 @@
+"""
+Single simulation runs for batch experiments, and running many of them at once.
+A run gets everything it needs (its Config and the node positions) and returns
+its metrics as a plain record, so runs are independent and can execute in worker
+processes. The seed of a run is set from its Config, so a run gives the same
+results no matter in which process or order it executes.
+"""
+import collections
+import concurrent.futures
+import enum
+import glob
+import hashlib
+import itertools
+import json
+import os
+import math
+import random
+import statistics
+import time
+
+import numpy as np
+import yaml
+
+from lib.common import Graph, find_random_position, run_graph_updates, search_radius, setup_asymmetric_links
+from lib.config import Config
+from lib.discrete_event import BroadcastPipe, run_simulation_time
+from lib.kernel import make_environment
+from lib.link import LinkBudget
+from lib.metrics import MetricsCollector, PacketLog
+from lib.mobility import MobilityEngine
+from lib.node import MeshNode
+from lib.packet import ActivePackets, PacketRegistry, fact_horizon
+from lib.spatial import SpatialGrid
+from lib.trace import TraceRecorder
+
+# One run of a batch: coords are the (x, y) positions of the nodes, overrides are Config
+# attributes to set besides the router type, number of nodes and seed.
+Job = collections.namedtuple('Job', ['routerType', 'nrNodes', 'rep', 'seed', 'coords', 'engine', 'overrides'])
+
+
+class TempNode:
+    """A lightweight node-like object with .x and .y attributes."""
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+
+def generate_positions(conf, nrNodes, rep):
+    """ Random node positions for repetition rep, the same for every router type. """
+    random.seed(rep)
+    found = False
+    temp_nodes = []
+
+    # We attempt to place 'nrNodes' one by one using findRandomPosition,
+    # but pass in a list of TempNode objects so it can do n.x, n.y
+    while not found:
+        temp_nodes = []
+        # spatial index of the nodes placed so far, so each try only checks nearby nodes
+        grid = SpatialGrid(search_radius(conf, 2 * conf.GL))
+        for _ in range(nrNodes):
+            xnew, ynew = find_random_position(conf, temp_nodes, grid)
+            if xnew is None:
+                # means we failed to place a node
+                break
+            # Wrap coordinates in a TempNode
+            grid.insert(len(temp_nodes), xnew, ynew)
+            temp_nodes.append(TempNode(xnew, ynew))
+
+        if len(temp_nodes) == nrNodes:
+            found = True
+
+    # Convert the final TempNodes to (x, y) tuples
+    return [(tn.x, tn.y) for tn in temp_nodes]
+
+
+def make_config(routerType, nrNodes, seed, engine=None, overrides=None):
+    """ A fresh Config for one run. """
+    conf = Config()
+    for name, value in (overrides or {}).items():
+        if not hasattr(conf, name):
+            raise AttributeError(f'Config has no attribute {name}')
+        setattr(conf, name, value)
+    conf.SELECTED_ROUTER_TYPE = routerType
+    if engine is not None:
+        conf.ENGINE = engine
+    conf.NR_NODES = nrNodes
+    conf.update_router_dependencies()
+    conf.SEED = seed
+    return conf
+
+
+def job_config(job):
+    return make_config(job.routerType, job.nrNodes, job.seed, job.engine, job.overrides)
+
+
+def job_cost(job):
+    """ Rough estimate of the run time of a job: the number of messages generated in it. """
+    conf = job_config(job)
+    return job.nrNodes * conf.SIMTIME / conf.PERIOD
+
+
+SWEEP_KEYS = ('name', 'routerTypes', 'repetitions', 'numberOfNodes', 'parameters', 'ciTargets', 'maxRepetitions', 'confidence', 'search')
+SEARCH_KEYS = ('variable', 'range', 'metric', 'above', 'below', 'tolerance')
+
+# metrics of a record (see run_simulation) that can have a confidence interval target
+CI_METRICS = ('collisionRate', 'reachability', 'usefulness', 'meanDelay', 'meanTxAirUtil')
+# with ciTargets but without maxRepetitions, a point gets at most this many times its repetitions
+MAX_REPETITIONS_FACTOR = 10
+
+
+def load_sweep(path):
+    """
+    Reads a sweep specification from a YAML (or JSON) file, e.g.:
+
+        name: hopLimit            # subdirectory of out/report
+        routerTypes: [MANAGED_FLOOD]
+        repetitions: 3
+        numberOfNodes: [3, 5, 10, 15, 30]
+        parameters:               # Config attributes, a list is swept over
+          hopLimit: [3, 5, 7]
+          PERIOD: 300000
+        ciTargets:                # optional, see run_sweep
+          reachability: 2.0
+          meanDelay: 500
+        maxRepetitions: 20
+        confidence: 0.95
+        search:                   # optional, see find_saturation
+          variable: nrNodes       # or a Config attribute, e.g. PERIOD
+          range: [3, 100]
+          metric: collisionRate
+          above: 10               # or below: for a metric that drops
+          tolerance: 1
+
+    Every combination of the swept parameters is simulated for every router
+    type, number of nodes and repetition. With a search, numberOfNodes is not
+    used when the variable is nrNodes.
+    """
+    with open(path, 'r') as file:
+        spec = yaml.safe_load(file)
+    return normalize_sweep(spec, os.path.splitext(os.path.basename(path))[0])
+
+
+def normalize_sweep(spec, name):
+    """
+    Checks a sweep specification (see load_sweep) and returns a copy with the
+    defaults filled in; name is the default name of the sweep. Router types may
+    be given by name or as Config.ROUTER_TYPE.
+    """
+    spec = {key: value for key, value in spec.items() if value is not None}
+    unknown = set(spec) - set(SWEEP_KEYS)
+    if unknown:
+        raise ValueError(f'Unknown keys in sweep {name}: {", ".join(sorted(unknown))}, must be one of: {", ".join(SWEEP_KEYS)}')
+    required = ('routerTypes', 'repetitions') if (spec.get('search') or {}).get('variable') == 'nrNodes' else ('routerTypes', 'repetitions', 'numberOfNodes')
+    missing = [key for key in required if key not in spec]
+    if missing:
+        raise ValueError(f'Sweep {name} misses {", ".join(missing)}')
+    spec.setdefault('name', name)
+    spec['parameters'] = dict(spec.get('parameters') or {})
+    conf = Config()
+    spec['routerTypes'] = [conf.ROUTER_TYPE[routerType] if isinstance(routerType, str) else routerType for routerType in spec['routerTypes']]
+    for parameter in spec['parameters']:
+        if not hasattr(conf, parameter):
+            raise AttributeError(f'Config has no attribute {parameter}')
+    spec['ciTargets'] = dict(spec.get('ciTargets') or {})
+    unknown = set(spec['ciTargets']) - set(CI_METRICS)
+    if unknown:
+        raise ValueError(f'No confidence interval for {", ".join(sorted(unknown))} in sweep {name}, must be one of: {", ".join(CI_METRICS)}')
+    spec.setdefault('confidence', 0.95)
+    if spec.get('search'):
+        spec['search'] = dict(spec['search'])
+        validate_search(spec, name)
+    return spec
+
+
+def validate_search(spec, name):
+    search = spec['search']
+    unknown = set(search) - set(SEARCH_KEYS)
+    if unknown:
+        raise ValueError(f'Unknown keys in the search of sweep {name}: {", ".join(sorted(unknown))}, must be one of: {", ".join(SEARCH_KEYS)}')
+    variable = search.get('variable')
+    if variable != 'nrNodes' and not hasattr(Config(), str(variable)):
+        raise AttributeError(f'The search variable must be nrNodes or a Config attribute, not {variable}')
+    if variable in spec['parameters']:
+        raise ValueError(f'The search variable {variable} is also in the parameters of sweep {name}')
+    if search.get('metric') not in CI_METRICS:
+        raise ValueError(f'The search metric must be one of: {", ".join(CI_METRICS)}')
+    if ('above' in search) == ('below' in search):
+        raise ValueError(f'The search of sweep {name} needs either above or below')
+    searchRange = search.get('range')
+    if not isinstance(searchRange, (list, tuple)) or len(searchRange) != 2 or not all(isinstance(value, (int, float)) for value in searchRange):
+        raise ValueError(f'The search range of sweep {name} must be [lowest, highest]')
+    search.setdefault('tolerance', 1)
+    if not search['tolerance'] > 0:
+        raise ValueError(f'The search tolerance of sweep {name} must be positive')
+
+
+def parameter_grid(parameters):
+    """ Every combination of the parameters as a dict of Config overrides; list values are swept over. """
+    names = list(parameters)
+    values = [value if isinstance(value, list) else [value] for value in parameters.values()]
+    return [dict(zip(names, combination)) for combination in itertools.product(*values)]
+
+
+def parameter_label(overrides, parameters):
+    """ Short name of a combination of the parameters of a sweep, from the swept ones only, e.g. 'hopLimit5_MODEM2'. """
+    return '_'.join(f'{name}{overrides[name]}' for name, value in parameters.items() if isinstance(value, list))
+
+
+def sweep_points(spec):
+    """ The (overrides, routerTypeIndex, routerType, nrNodes) of every point of a sweep, i.e. everything but the repetition. """
+    return [(overrides, rt_i, routerType, nrNodes)
+            for overrides in parameter_grid(spec['parameters'])
+            for rt_i, routerType in enumerate(spec['routerTypes'])
+            for nrNodes in spec['numberOfNodes']]
+
+
+def point_jobs(point, reps, engine=None, positions=None):
+    """
+    The jobs of repetitions reps of a sweep point, with seed routerTypeIndex * 10000 + rep.
+    The positions only depend on the repetition, so all router types are compared on the
+    same topologies (as are swept parameters that do not change the placement); pass the
+    same positions dict to reuse them between the points of a sweep.
+    """
+    overrides, rt_i, routerType, nrNodes = point
+    positions = {} if positions is None else positions
+    jobs = []
+    for rep in reps:
+        key = (repr(sorted(overrides.items())), nrNodes, rep)
+        if key not in positions:
+            positions[key] = generate_positions(make_config(routerType, nrNodes, rep, engine, overrides), nrNodes, rep)
+        jobs.append(Job(routerType, nrNodes, rep, rt_i * 10000 + rep, positions[key], engine, overrides))
+    return jobs
+
+
+def sweep_jobs(spec, engine=None):
+    """ The jobs of a sweep with a fixed number of repetitions per point. """
+    positions = {}
+    return [job for point in sweep_points(spec) for job in point_jobs(point, range(spec['repetitions']), engine, positions)]
+
+
+def t_quantile(p, df):
+    """
+    Quantile p of Student's t-distribution with df degrees of freedom: exact for
+    df 1 and 2, a Cornish-Fisher expansion (within 1% at confidence levels up to
+    99%) from df 3 on.
+    """
+    if df == 1:
+        return math.tan(math.pi * (p - 0.5))
+    if df == 2:
+        return (2 * p - 1) * math.sqrt(2 / (4 * p * (1 - p)))
+    z = statistics.NormalDist().inv_cdf(p)
+    return (z + (z**3 + z) / (4 * df) + (5 * z**5 + 16 * z**3 + 3 * z) / (96 * df**2)
+            + (3 * z**7 + 19 * z**5 + 17 * z**3 - 15 * z) / (384 * df**3)
+            + (79 * z**9 + 776 * z**7 + 1482 * z**5 - 1920 * z**3 - 945 * z) / (92160 * df**4))
+
+
+def confidence_halfwidth(values, confidence=0.95):
+    """ Half-width of the confidence interval of the mean of values, ignoring NaNs; infinite with fewer than two values. """
+    values = [value for value in values if not math.isnan(value)]
+    if len(values) < 2:
+        return math.inf
+    return t_quantile((1 + confidence) / 2, len(values) - 1) * statistics.stdev(values) / math.sqrt(len(values))
+
+
+def run_sweep(spec, engine=None, nrJobs=1, showGraph=False, cache=None, force=False, points=None, positions=None):
+    """
+    Runs a sweep and returns (results, repetitions): the (record, packetLog) of every
+    run keyed by (parameter_label, routerType, nrNodes, rep), and the number of
+    repetitions of every point keyed by (parameter_label, routerType, nrNodes).
+    Every point gets spec['repetitions'] runs. With spec['ciTargets'], a mapping of
+    metrics (CI_METRICS) to the largest acceptable half-width of their confidence
+    interval (at spec['confidence'], in the unit of the metric), repetitions are added
+    in rounds to the points where an interval is still wider than its target, until
+    all are narrow enough or spec['maxRepetitions'] (if it is None or missing,
+    MAX_REPETITIONS_FACTOR * spec['repetitions']) is reached. Each round adds one
+    repetition per point, or more if there are fewer points left than nrJobs.
+    points restricts the sweep to some of its sweep_points, and positions is a dict
+    of node positions to share between calls (see point_jobs).
+    """
+    targets = spec.get('ciTargets') or {}
+    maxRepetitions = spec['repetitions']
+    if targets:
+        maxRepetitions = spec.get('maxRepetitions') or MAX_REPETITIONS_FACTOR * spec['repetitions']
+    confidence = spec.get('confidence', 0.95)
+    positions = {} if positions is None else positions
+    results = {}
+    repetitions = {}
+    pending = {}
+    for point in sweep_points(spec) if points is None else points:
+        overrides, _, routerType, nrNodes = point
+        key = (parameter_label(overrides, spec['parameters']), routerType, nrNodes)
+        repetitions[key] = 0
+        pending[key] = (point, spec['repetitions'])
+    while pending:
+        jobs = []
+        for key, (point, count) in pending.items():
+            jobs += point_jobs(point, range(repetitions[key], repetitions[key] + count), engine, positions)
+            repetitions[key] += count
+        if nrJobs > 1:
+            print(f"Running {len(jobs)} simulations on {nrJobs} processes")
+        runs = run_jobs(jobs, nrJobs, maxRepetitions, showGraph, cache, force)
+        for job, run in zip(jobs, runs):
+            results[(parameter_label(job.overrides, spec['parameters']), job.routerType, job.nrNodes, job.rep)] = run
+        wide = []
+        for key, (point, _) in pending.items():
+            if repetitions[key] >= maxRepetitions:
+                continue
+            records = [results[key + (rep,)][0] for rep in range(repetitions[key])]
+            if any(confidence_halfwidth([record[metric] for record in records], confidence) > target for metric, target in targets.items()):
+                wide.append((key, point))
+        pending = {key: (point, min(max(1, nrJobs // len(wide)), maxRepetitions - repetitions[key])) for key, point in wide}
+        if pending:
+            print(f"Confidence intervals above target at {len(pending)} of {len(repetitions)} sweep points, adding repetitions")
+    return results, repetitions
+
+
+def simulation_progress(env, conf, currentRep, repetitions):
+    """
+    Keep track of the ratio of real time per sim-second over
+    a fixed sliding window, so if the simulation slows down near the end,
+    the time-left estimate adapts quickly.
+    """
+    endTime = conf.SIMTIME
+    startWallTime = time.time()
+    lastWallTime = startWallTime
+    lastEnvTime = env.now
+
+    # We'll store the last N ratio measurements
+    N = 10
+    ratios = collections.deque(maxlen=N)
+
+    while True:
+        fraction = env.now / endTime
+        fraction = min(fraction, 1.0)
+
+        # Current real time
+        currentWallTime = time.time()
+        realTimeDelta = currentWallTime - lastWallTime
+        simTimeDelta = env.now - lastEnvTime
+
+        # Compute new ratio if sim actually advanced
+        if simTimeDelta > 0:
+            instant_ratio = realTimeDelta / simTimeDelta
+            ratios.append(instant_ratio)
+
+        # If we have at least one ratio, compute a 'recent average'
+        if len(ratios) > 0:
+            avgRatio = sum(ratios) / len(ratios)
+        else:
+            avgRatio = 0.0
+
+        # time_left_est = avg_ratio * (endTime - env.now)
+        simTimeRemaining = endTime - env.now
+        timeLeftEst = simTimeRemaining * avgRatio
+
+        # Format mm:ss
+        minutes = int(timeLeftEst // 60)
+        seconds = int(timeLeftEst % 60)
+
+        print(
+            f"\rSimulation {currentRep+1}/{repetitions} progress: "
+            f"{fraction*100:.1f}% | ~{minutes}m{seconds}s left...",
+            end="", flush=True
+        )
+
+        # If done or overshoot
+        if fraction >= 1.0:
+            break
+
+        # Update references
+        lastWallTime = currentWallTime
+        lastEnvTime = env.now
+
+        yield env.timeout(conf.TEN_SECONDS_INTERVAL)
+
+
+def run_simulation(conf, coords, traceFile=None, progress=None, showGraph=False, verboseprint=lambda *args, **kwargs: None):
+    """
+    Simulates one run with nodes at coords and returns (record, packetLog), with
+    the metrics of the run in the record (rates in percent) and the PacketLog if
+    conf.PACKET_LOG is set (else None). progress is (current repetition,
+    repetitions) to print the progress of the run while it executes.
+    """
+    random.seed(conf.SEED)
+    env = make_environment(conf.ENGINE)
+    bc_pipe = BroadcastPipe(env, neighborDelivery=conf.NEIGHBOR_DELIVERY)
+
+    if progress is not None:
+        env.process(simulation_progress(env, conf, progress[0], progress[1]))
+
+    nodes = []
+    links = LinkBudget(conf, nodes)
+    messages = []
+    packetLog = PacketLog(conf.NR_NODES) if conf.PACKET_LOG else None
+    metrics = MetricsCollector(packetLog)
+    packets = PacketRegistry(links, metrics, retain=conf.RETAIN_PACKETS, expiry=fact_horizon(conf))
+    packetsAtN = [ActivePackets() for _ in range(conf.NR_NODES)]
+    trace = TraceRecorder(traceFile) if traceFile else None
+    messageSeq = {"val": 0}
+
+    graph = Graph(conf) if showGraph else None
+    for nodeId in range(conf.NR_NODES):
+        x, y = coords[nodeId]
+
+        # We create a nodeConfig dict so that MeshNode will use that
+        nodeConfig = {
+            'x': x,
+            'y': y,
+            'z': conf.HM,
+            'isRouter': False,
+            'isRepeater': False,
+            'isClientMute': False,
+            'hopLimit': conf.hopLimit,
+            'antennaGain': conf.GL
+        }
+
+        node = MeshNode(
+            conf, nodes, links, env, bc_pipe, nodeId, conf.PERIOD,
+            messages, packetsAtN, packets, metrics, nodeConfig,
+            messageSeq, verboseprint, trace
+        )
+        nodes.append(node)
+        if graph is not None:
+            graph.add_node(node)
+
+    if conf.MOVEMENT_ENABLED and conf.MOBILITY_ENGINE:
+        MobilityEngine(conf, env, nodes, links)
+    if conf.MOVEMENT_ENABLED and graph is not None:
+        env.process(run_graph_updates(env, graph, nodes, conf.ONE_MIN_INTERVAL))
+
+    totalPairs, symmetricLinks, asymmetricLinks, noLinks = setup_asymmetric_links(conf, nodes)
+
+    # Start simulation
+    run_simulation_time(conf, env)
+    packets.finish()
+    if trace is not None:
+        trace.close()
+
+    # Calculate stats
+    summary = metrics.summary(nodes, messageSeq["val"])
+    record = {
+        'collisionRate': summary['collisionRate'] * 100,
+        'reachability': summary['reachability'] * 100,
+        'usefulness': summary['usefulness'] * 100,
+        'meanDelay': summary['meanDelay'],
+        'meanTxAirUtil': sum([n.txAirUtilization for n in nodes]) / conf.NR_NODES,
+        'nrCollisions': summary['collisions'],
+        'nrSensed': summary['sensed'],
+        'nrReceived': summary['received'],
+        'usefulPackets': summary['useful'],
+        'nrMessages': messageSeq["val"],
+        'asymmetricLinkRate': 0,
+        'symmetricLinkRate': 0,
+        'noLinkRate': 0,
+    }
+    if conf.MODEL_ASYMMETRIC_LINKS:
+        record['asymmetricLinkRate'] = round(asymmetricLinks / totalPairs * 100, 2)
+        record['symmetricLinkRate'] = round(symmetricLinks / totalPairs * 100, 2)
+        record['noLinkRate'] = round(noLinks / totalPairs * 100, 2)
+    return record, packetLog
+
+
+def trace_file(conf, job):
+    """ Trace file of a job, e.g. out/trace.bin -> out/trace_MANAGED_FLOOD_30_0.bin, or None without tracing. """
+    if not conf.TRACE_FILE:
+        return None
+    root, ext = os.path.splitext(conf.TRACE_FILE)
+    return f"{root}_{job.routerType.name}_{job.nrNodes}_{job.rep}{ext}"
+
+
+def run_job(job, progress=None, showGraph=False):
+    conf = job_config(job)
+    return run_simulation(conf, job.coords, trace_file(conf, job), progress, showGraph)
+
+
+def to_json(value):
+    # JSON representation of the values in a Config and in the records
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, enum.Enum):
+        return value.value
+    return repr(value)
+
+
+_codeVersion = None
+
+
+def code_version():
+    """ Hash of the simulator source code (lib/*.py), so cached results are not reused after it changed. """
+    global _codeVersion
+    if _codeVersion is None:
+        digest = hashlib.sha256()
+        for path in sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), '*.py'))):
+            with open(path, 'rb') as file:
+                digest.update(os.path.basename(path).encode())
+                digest.update(file.read())
+        _codeVersion = digest.hexdigest()
+    return _codeVersion
+
+
+def job_key(job):
+    """
+    Hash of everything that determines the results of a job: its Config (which
+    includes the router type and seed), positions and the code. ENGINE is left out,
+    which assumes that both engines give identical results for a seed (checked by
+    tests/test_kernel.py); a run on one engine is served to the other from the cache.
+    """
+    conf = job_config(job)
+    # the modem profile follows from the other fields
+    fields = {name: value for name, value in vars(conf).items() if name not in ('ENGINE', 'modemProfile')}
+    content = json.dumps({'config': fields, 'coords': job.coords, 'code': code_version()}, sort_keys=True, default=to_json)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+class ResultCache:
+    """
+    Records of finished runs on disk, one JSON file per run named after its job_key,
+    so a run with the same configuration, positions and code is not simulated again.
+    Delete the directory to clear it. Packet logs are not cached.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.json')
+
+    def get(self, key):
+        try:
+            with open(self.path(key), 'r') as file:
+                return json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def put(self, key, record):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file first, so a reader never sees a partial record
+        temporary = f'{path}.{os.getpid()}.tmp'
+        with open(temporary, 'w') as file:
+            json.dump(record, file, default=to_json)
+        os.replace(temporary, path)
+
+
+def run_jobs(jobs, nrJobs=1, repetitions=None, showGraph=False, cache=None, force=False):
+    """
+    Runs every job and returns their (record, packetLog) in the order of jobs.
+    With nrJobs > 1, the jobs run in a pool of that many worker processes, the
+    longest ones (job_cost) first.
+    With a ResultCache, jobs whose record is in the cache are not run (their
+    packetLog is None) unless force is set, and the record of every job is stored
+    in it as soon as it finished, so an interrupted batch resumes where it stopped
+    when it is started again. Runs that write a trace are never served from the cache.
+    """
+    results = [None] * len(jobs)
+    keys = [None] * len(jobs)
+    todo = []
+    for i, job in enumerate(jobs):
+        if cache is not None and not job_config(job).TRACE_FILE:
+            keys[i] = job_key(job)
+            record = None if force else cache.get(keys[i])
+            if record is not None:
+                results[i] = (record, None)
+                continue
+        todo.append(i)
+    if cache is not None and len(todo) < len(jobs):
+        print(f"{len(jobs) - len(todo)} of {len(jobs)} runs served from the cache")
+
+    def finished(i, result):
+        results[i] = result
+        if keys[i] is not None:
+            cache.put(keys[i], result[0])
+
+    if nrJobs <= 1:
+        for i in todo:
+            job = jobs[i]
+            finished(i, run_job(job, None if repetitions is None else (job.rep, repetitions), showGraph))
+        return results
+    with concurrent.futures.ProcessPoolExecutor(max_workers=nrJobs) as pool:
+        # longest first, so the workers finish at about the same time
+        futures = {pool.submit(run_job, jobs[i]): i for i in sorted(todo, key=lambda i: job_cost(jobs[i]), reverse=True)}
+        for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            i = futures[future]
+            finished(i, future.result())
+            job = jobs[i]
+            print(f"\rFinished {done}/{len(todo)} runs (last: {job.routerType.name}, {job.nrNodes} nodes, repetition {job.rep+1})", end="", flush=True)
+    print()
+    return results
+
+
+Saturation = collections.namedtuple('Saturation', ['within', 'beyond', 'evaluations'])
+
+
+def search_points(spec):
+    """ The sweep points to search the saturation of, with nrNodes None if that is the search variable. """
+    if spec['search']['variable'] == 'nrNodes':
+        spec = dict(spec, numberOfNodes=[None])
+    return sweep_points(spec)
+
+
+def find_saturation(spec, point, engine=None, nrJobs=1, cache=None, force=False, positions=None):
+    """
+    Searches spec['search']['range'] of the search variable (nrNodes or a Config
+    attribute) of a search point for where the mean of the metric goes above (or
+    below) the limit. Both ends of the range are simulated to bracket the threshold,
+    which is then bisected until the bracket is no wider than the tolerance, so it
+    takes about log2(range / tolerance) + 2 evaluations. The metric should be
+    monotonic in the variable over the range. Each value is evaluated with run_sweep,
+    so with the same seeds and topologies as a grid, the repetitions or confidence
+    interval targets of the spec, and served from the cache if it was simulated before.
+    Returns Saturation(within, beyond, evaluations): the values on either side of the
+    threshold, the last one where the limit is not crossed and the first one where it
+    is (both None if the range does not contain the threshold), and the (value, mean,
+    repetitions) of every evaluated value in order.
+    """
+    search = spec['search']
+    variable = search['variable']
+    metric = search['metric']
+    limit = search['above'] if 'above' in search else search['below']
+    overrides, rt_i, routerType, nrNodes = point
+    positions = {} if positions is None else positions
+    evaluations = []
+
+    def crossed(value):
+        if variable == 'nrNodes':
+            searchPoint = (overrides, rt_i, routerType, value)
+        else:
+            searchPoint = (dict(overrides, **{variable: value}), rt_i, routerType, nrNodes)
+        results, repetitions = run_sweep(spec, engine, nrJobs, False, cache, force, [searchPoint], positions)
+        (key, count), = repetitions.items()
+        mean = np.nanmean([results[key + (rep,)][0][metric] for rep in range(count)])
+        evaluations.append((value, mean, count))
+        return mean > limit if 'above' in search else mean < limit
+
+    lowest, highest = search['range']
+    integer = all(isinstance(value, int) for value in (lowest, highest, search['tolerance']))
+    low, high = lowest, highest
+    lowCrossed = crossed(low)
+    highCrossed = crossed(high)
+    if lowCrossed == highCrossed:
+        return Saturation(None, None, evaluations)
+    while abs(high - low) > search['tolerance']:
+        middle = (low + high) // 2 if integer else (low + high) / 2
+        if middle in (low, high):
+            break
+        if crossed(middle) == highCrossed:
+            high = middle
+        else:
+            low = middle
+    if highCrossed:
+        return Saturation(low, high, evaluations)
+    return Saturation(high, low, evaluations)
@@ -8,9 +8,11 @@ import yaml
 from matplotlib.widgets import Button, Slider, RadioButtons, TextBox
 
 from lib import phy
+from lib.spatial import SpatialGrid
 
 try:
-	matplotlib.use("TkAgg")
+	# a backend set in MPLBACKEND (e.g. Agg to run without a display) takes precedence
+	matplotlib.use(os.environ.get("MPLBACKEND", "TkAgg"))
 except ImportError:
 	print('Tkinter is needed. Install python3-tk with your package manager.')
 	exit(1)
@@ -73,7 +75,7 @@ def gen_scenario(conf):
 		nx = nodeX[-1]
 		ny = nodeY[-1]
 		ax.annotate(str(len(nodeX)-1), (nx-5, ny+5))
-		circle = plt.Circle((nx, ny), radius=phy.MAXRANGE, color=plt.cm.Set1(len(nodeX)-1), alpha=0.1)
+		circle = plt.Circle((nx, ny), radius=phy.modem_profile(conf).max_range(2*conf.GL), color=plt.cm.Set1(len(nodeX)-1), alpha=0.1)
 		circles.append(circle)
 		ax.add_patch(circle)
 		ax.scatter(nx, ny) # small dot in the middle
@@ -113,7 +115,7 @@ def gen_scenario(conf):
 	button.on_clicked(submit)
 	
 	def submit_gain(text):
-		circles[-1].set_radius(phy.estimate_max_range(float(text)))
+		circles[-1].set_radius(phy.modem_profile(conf).max_range(float(text)))
 		fig.canvas.draw_idle()
 	gain_textbox.on_submit(submit_gain)
 
@@ -161,7 +163,19 @@ def gen_scenario(conf):
 	return nodeDict
 
 
-def find_random_position(conf, nodes):
+def search_radius(conf, gain, txZ=phy.conf.HM, rxZ=phy.conf.HM):
+	# Upper bound on the range for a spatial grid query, with some slack for the tolerance of the root finder.
+	# Receivers outside of it can never sense the transmitter, those inside still need an exact check.
+	return max(1.05 * phy.modem_profile(conf).max_range(gain, txZ, rxZ) + 10, conf.MINDIST)
+
+
+def find_random_position(conf, nodes, grid=None):
+	# grid is a SpatialGrid with the positions of the nodes; if not given, it is built from nodes
+	radius = search_radius(conf, 2*conf.GL)
+	if grid is None:
+		grid = SpatialGrid(radius)
+		for i, n in enumerate(nodes):
+			grid.insert(i, n.x, n.y)
 	foundMin = True
 	foundMax = False
 	tries = 0
@@ -172,16 +186,18 @@ def find_random_position(conf, nodes):
 		b = random.random()
 		posx = a*conf.XSIZE+conf.OX-conf.XSIZE/2
 		posy = b*conf.YSIZE+conf.OY-conf.YSIZE/2
-		if len(nodes) > 0:
-			for n in nodes:
-				dist = calc_dist(n.x, posx, n.y, posy)
+		if len(grid) > 0:
+			# only the nodes in range can be too close or able to reach it
+			for key in grid.query(posx, posy, radius):
+				nx, ny = grid.positions[key]
+				dist = calc_dist(nx, posx, ny, posy)
 				if dist < conf.MINDIST:
 					foundMin = False
 					break
 				pathLoss = phy.estimate_path_loss(conf, dist, conf.FREQ)
 				rssi = conf.PTX + 2*conf.GL - pathLoss
 				# At least one node should be able to reach it
-				if rssi >= conf.SENSMODEM[conf.MODEM]:
+				if rssi >= phy.modem_profile(conf).sensitivity:
 					foundMax = True
 			if foundMin and foundMax:
 				x = posx
@@ -213,25 +229,30 @@ def calc_dist(x0, x1, y0, y1, z0=0, z1=0):
 scheduleIdx = 0
 
 
-def plot_schedule(conf, packets, messages):
+def plot_schedule(conf, packetLog, messages):
+	seqs = packetLog.column('seq')
+	txNodeIds = packetLog.column('txNodeId')
+	startTimes = packetLog.column('startTime')
+	endTimes = packetLog.column('endTime')
+	timesOnAir = packetLog.column('timeOnAir')
+	isAcks = packetLog.column('isAck')
+	collided = packetLog.flags('collided')
+	received = packetLog.flags('received')
+
 	def draw_schedule(i):
 		t = timeSequences[i]
 		plt.suptitle('Time schedule {}/{}\nDouble click to continue.'.format(i+1, len(timeSequences)))
-		for p in packets:  # collisions
-			if p.seq in [m.seq for m in t]:
-				for rxId, bool in enumerate(p.collidedAtN):
-					if bool:
-						plt.barh(rxId, p.timeOnAir, left=p.startTime, color='red', edgecolor='r')
-		for p in packets:  # transmissions
-			if p.seq in [m.seq for m in t]:
-				color = 'orange' if p.isAck else 'blue'
-				plt.barh(p.txNodeId, p.timeOnAir, left=p.startTime, color=color, edgecolor='k')
-				plt.text(p.startTime+p.timeOnAir/2, p.txNodeId, str(p.seq), horizontalalignment='center', verticalalignment='center', fontsize=12)
-		for p in packets:  # receptions
-			if p.seq in [m.seq for m in t]:
-				for rxId, bool in enumerate(p.receivedAtN):
-					if bool:
-						plt.barh(rxId, p.timeOnAir, left=p.startTime, color='green', edgecolor='green')
+		inSequence = np.flatnonzero(np.isin(seqs, [m.seq for m in t]))
+		for p in inSequence:  # collisions
+			for rxId in np.flatnonzero(collided[p]):
+				plt.barh(rxId, timesOnAir[p], left=startTimes[p], color='red', edgecolor='r')
+		for p in inSequence:  # transmissions
+			color = 'orange' if isAcks[p] else 'blue'
+			plt.barh(txNodeIds[p], timesOnAir[p], left=startTimes[p], color=color, edgecolor='k')
+			plt.text(startTimes[p]+timesOnAir[p]/2, txNodeIds[p], str(seqs[p]), horizontalalignment='center', verticalalignment='center', fontsize=12)
+		for p in inSequence:  # receptions
+			for rxId in np.flatnonzero(received[p]):
+				plt.barh(rxId, timesOnAir[p], left=startTimes[p], color='green', edgecolor='green')
 		maxTime = 0
 		for m in t:  # message generations
 			plt.arrow(m.genTime, m.origTxNodeId - 0.4, 0, 0.5, head_width=0.02 * (m.endTime - m.genTime), head_length=0.3, fc='k', ec='k')
@@ -247,8 +268,10 @@ def plot_schedule(conf, packets, messages):
 
 	# combine all messages with overlapping packets in one time sequence
 	overlapping = [[m] for m in messages]
+	lastEnd = np.zeros(len(messages) + 1)
+	np.maximum.at(lastEnd, seqs, endTimes)
 	for m in messages:
-		m.endTime = max([p.endTime for p in packets if p.seq == m.seq])
+		m.endTime = lastEnd[m.seq]
 	for m1 in messages:
 		for m2 in messages:
 			if m1 != m2:
@@ -345,7 +368,7 @@ class Graph:
 		# Plot the coverage circle
 		circle = plt.Circle(
 			(node.x, node.y),
-			radius=phy.estimate_max_range(node.antennaGain),
+			radius=phy.modem_profile(self.conf).max_range(node.antennaGain),
 			color=plt.cm.Set1(node.nodeid),
 			alpha=0.1
 		)
@@ -389,8 +412,8 @@ def setup_asymmetric_links(conf, nodes):
 				rssiAB = conf.PTX + nodeA.antennaGain - pathLossAB - offsetAB
 				rssiBA = conf.PTX + nodeB.antennaGain - pathLossAB - offsetBA
 
-				canAhearB = (rssiAB >= conf.SENSMODEM[conf.MODEM])
-				canBhearA = (rssiBA >= conf.SENSMODEM[conf.MODEM])
+				canAhearB = (rssiAB >= phy.modem_profile(conf).sensitivity)
+				canBhearA = (rssiBA >= phy.modem_profile(conf).sensitivity)
 
 				totalPairs += 1
 				if canAhearB and canBhearA:
@@ -48,6 +48,19 @@ class Config:
         self.CHANNEL_NUM = 27  # Channel number
 
         self.PLOT = True # whether to plot the time schedule of packets after the simulation
+        self.RETAIN_PACKETS = False  # False drops a packet once it is off the air and keeps only a few facts per seq that the routing still needs (see fact_horizon
+        # in lib/packet.py for how long), so memory stays bounded; True keeps every packet object until the end of the simulation, with the same results
+        self.PACKET_LOG = True  # record finished packets in a columnar log for the statistics, plot_schedule and sim_report (3 bits per node per packet)
+        self.CHANNEL_IDLE_WAKEUP = False  # when the channel is busy before transmitting, sleep until the last detected packet has ended and draw the backoff then, instead of polling CAD after every backoff
+        self.NEIGHBOR_DELIVERY = False  # deliver a packet only to the nodes that can sense it instead of to every node; faster, but same-time events are handled in another order, so results for a seed differ
+        self.ENGINE = 'simpy'  # discrete-event engine: 'simpy' or 'fast' (lib/kernel.py, same results for a fixed seed); --engine on the command line
+        self.TRACE_FILE = None  # path of a binary event trace of the run, e.g. os.path.join('out', 'trace.bin') (format and reader in lib/trace.py); None disables tracing
+        self.SPARSE_RECEIVERS = False  # store the per-receiver state of a packet only for the nodes that can detect it (saves memory for large meshes)
+        self.GC_TUNING = False  # gc.freeze() the objects created during setup and collect the youngest generation only every GC_THRESHOLD allocations while the simulation runs
+        self.GC_THRESHOLD = 50000
+        self.PACKET_HISTORY_SIZE = None  # max. number of sequence numbers a node remembers for duplicate suppression (the firmware keeps about 2 per node in the mesh); None is unbounded
+        self.PACKET_HISTORY_EXPIRY = None  # ms after which a node forgets that it heard a sequence number (10 * self.ONE_MIN_INTERVAL in the firmware); None never expires
+        self.RX_RSSI_HISTORY = 256  # number of sequence numbers per node for which the RSSI of the last received copy is kept (for the SNR-based transmit delay)
         ### End of discrete-event specific ###
 
         ### PHY parameters (normally no change needed) ###
@@ -76,6 +89,7 @@ class Config:
 
         # Initializers
         self.NR_NODES = None
+        self.modemProfile = None  # airtimes, slot time, thresholds etc. of MODEM, built by lib.phy.modem_profile on first use
         # End of initializers
 
         ############################
@@ -118,6 +132,9 @@ class Config:
         self.SMART_POSITION_DISTANCE_MIN_TIME = 30 * self.ONE_SECOND_INTERVAL
         # This mirrors the firmware's approach to monitoring channel utilization
         self.CHANNEL_UTILIZATION_PERIODS = 6
+        # Move all mobile nodes from one process with the vectorized engine in lib/mobility.py, instead of with
+        # a process per node; the moves follow the same distributions, which scales to thousands of mobile nodes
+        self.MOBILITY_ENGINE = False
 
     # Function that needs to be run to ensure the router dependent variables change appropriately
     def update_router_dependencies(self):
@@ -1,39 +1,81 @@
+import gc
 import os
 
 import pandas as pd
 import simpy
 
+from lib.kernel import make_store
 
-def sim_report(conf, data, subdir, param):
+
+def sim_report(conf, data, subdir, param, packetLog=None):
 	os.makedirs(os.path.join("out", "report", subdir), exist_ok=True)
 	fname = f"simReport_{conf.MODEM}_{param}.csv"
 	df_new = pd.DataFrame(data)
 	df_new.to_csv(os.path.join("out", "report", subdir, fname), index=False)
+	packetsPath = os.path.join("out", "report", subdir, f"packets_{conf.MODEM}_{param}.csv")
+	if packetLog is not None:
+		# one row per packet, from the columns of the log
+		pd.DataFrame(packetLog.table()).to_csv(packetsPath, index=False)
+	elif os.path.exists(packetsPath):
+		# without a log (e.g. a run served from the cache), a packet CSV of an earlier run would not match this report
+		os.remove(packetsPath)
+
+
+def run_simulation_time(conf, env):
+	""" Runs env until conf.SIMTIME, with fewer garbage collections if conf.GC_TUNING is set. """
+	if not conf.GC_TUNING:
+		env.run(until=conf.SIMTIME)
+		return
+	# the nodes, links and processes created during setup live until the end, so collections need not scan them
+	gc.collect()
+	gc.freeze()
+	thresholds = gc.get_threshold()
+	gc.set_threshold(conf.GC_THRESHOLD, *thresholds[1:])
+	try:
+		env.run(until=conf.SIMTIME)
+	finally:
+		gc.set_threshold(*thresholds)
+		gc.unfreeze()
 
 
 class BroadcastPipe:
-	def __init__(self, env, capacity=simpy.core.Infinity):
+	def __init__(self, env, capacity=simpy.core.Infinity, neighborDelivery=False):
 		self.env = env
 		self.capacity = capacity
 		self.pipes = []
+		# With neighborDelivery, a packet only reaches the pipes of the nodes that can sense it
+		# (packet.neighbors), instead of waking up every node in the simulation. A node that
+		# cannot sense a packet still takes it from its pipe, which delays the next packet it
+		# gets at the same time, so events at equal times are handled in a different order and
+		# the results for a seed differ from delivering to every node.
+		self.neighborDelivery = neighborDelivery
+		self.pipesByNode = {}
+
+	def output_pipes(self, packet):
+		if not self.pipes:
+			raise RuntimeError('There are no output pipes.')
+		if self.neighborDelivery:
+			return [self.pipesByNode[rx] for rx in packet.neighbors]
+		return self.pipes
 
 	def latency(self, packet):
 		# wait time that packet is on the air
 		yield self.env.timeout(packet.timeOnAir)
-		if not self.pipes:
-			raise RuntimeError('There are no output pipes.')
-		events = [store.put(packet) for store in self.pipes]
+		events = [store.put(packet) for store in self.output_pipes(packet)]
 		return self.env.all_of(events)
 
 	def put(self, packet):
 		self.env.process(self.latency(packet))
 		# this mimics start of reception
-		if not self.pipes:
-			raise RuntimeError('There are no output pipes.')
-		events = [store.put(packet) for store in self.pipes]
+		events = [store.put(packet) for store in self.output_pipes(packet)]
 		return self.env.all_of(events)
 
-	def get_output_conn(self):
-		pipe = simpy.Store(self.env, capacity=self.capacity)
+	def get_output_conn(self, nodeid=None):
+		pipe = make_store(self.env, capacity=self.capacity)
 		self.pipes.append(pipe)
+		if nodeid is None:
+			# pipes that are not tied to a node can only be served by broadcasting to all of them
+			self.neighborDelivery = False
+		else:
+			self.pipesByNode[nodeid] = pipe
 		return pipe
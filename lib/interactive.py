@@ -17,8 +17,9 @@ from matplotlib.widgets import TextBox
 
 from lib.config import Config
 import lib.phy as phy
-from lib.common import calc_dist, gen_scenario, find_random_position, Graph
+from lib.common import calc_dist, gen_scenario, find_random_position, search_radius, Graph
 from lib.server import WebSocketServer
+from lib.spatial import SpatialGrid
 
 conf = Config()
 HW_ID_OFFSET = 16
@@ -371,9 +372,11 @@ class InteractiveSim:
             # self.docker = True # DISABLED for Integration Testing
 
         self.graph = InteractiveGraph()
+        self.grid = SpatialGrid(search_radius(conf, 2 * conf.GL))
         for n in range(conf.NR_NODES):
             node = InteractiveNode(self.nodes, n, self.node_id_to_hw_id(n), n + TCP_PORT_OFFSET, config[n])
             self.nodes.append(node)
+            self.grid.insert(node.nodeid, node.x, node.y)
             self.graph.add_node(node)
             
             # Broadcast initial node state
@@ -739,7 +742,12 @@ class InteractiveSim:
         rxs = []
         rssis = []
         snrs = []
+        # Path loss decreases with the receiver height, so the range towards the highest node bounds the search
+        maxHeight = max((rx.z for rx in receivers), default=conf.HM)
+        inRange = set(self.grid.query(tx.x, tx.y, search_radius(conf, tx.antennaGain, tx.z, maxHeight)))
         for rx in receivers:
+            if rx.nodeid not in inRange:
+                continue
             dist_3d = calc_dist(tx.x, rx.x, tx.y, rx.y, tx.z, rx.z)
             pathLoss = phy.estimate_path_loss(conf, dist_3d, conf.FREQ, tx.z, rx.z)
             RSSI = conf.PTX + tx.antennaGain - pathLoss
@@ -0,0 +1,293 @@
+"""
+Lightweight discrete-event kernel with the scheduling semantics of simpy.
+
+Only what the simulator uses is implemented: processes, timeouts, plain events,
+AllOf conditions, a FIFO Store and a Resource. Events are ordered exactly like in
+simpy, by (time, priority, event id), and every interaction takes the same number
+of scheduling steps (e.g. a Store put is an event whose processing serves a waiting
+get, which is another event), so a run with a fixed seed gives the same results as
+with simpy. It leaves out simpy's generality: no interrupts or failed events
+(exceptions propagate out of run() right away), and a process that finishes while
+nobody waits for it is marked processed immediately instead of scheduling an event.
+"""
+import heapq
+import itertools
+
+import simpy
+
+URGENT = 0
+NORMAL = 1
+Infinity = float('inf')
+PENDING = object()
+
+ENGINES = ('simpy', 'fast')
+
+
+class Event:
+    __slots__ = ('env', 'callbacks', 'value')
+
+    def __init__(self, env):
+        self.env = env
+        self.callbacks = []
+        self.value = PENDING
+
+    @property
+    def triggered(self):
+        return self.value is not PENDING
+
+    @property
+    def processed(self):
+        return self.callbacks is None
+
+    def succeed(self, value=None):
+        if self.value is not PENDING:
+            raise RuntimeError(f'{self} has already been triggered')
+        self.value = value
+        self.env.schedule(self)
+        return self
+
+
+class Timeout(Event):
+    __slots__ = ()
+
+    def __init__(self, env, delay, value=None):
+        if delay < 0:
+            raise ValueError(f'Negative delay {delay}')
+        self.env = env
+        self.callbacks = []
+        self.value = value
+        env.schedule(self, NORMAL, delay)
+
+
+class Process(Event):
+    __slots__ = ('generator', 'target')
+
+    def __init__(self, env, generator):
+        if not hasattr(generator, 'throw'):
+            raise ValueError(f'{generator} is not a generator.')
+        super().__init__(env)
+        self.generator = generator
+        # start the process before the regular events of the current time
+        start = Event(env)
+        start.value = None
+        start.callbacks.append(self.resume)
+        env.schedule(start, URGENT)
+        self.target = start
+
+    @property
+    def is_alive(self):
+        return self.value is PENDING
+
+    def resume(self, event):
+        env = self.env
+        env.activeProcess = self
+        while True:
+            try:
+                event = self.generator.send(event.value)
+            except StopIteration as stop:
+                self.value = stop.value
+                if self.callbacks:
+                    env.schedule(self)
+                else:
+                    self.callbacks = None
+                break
+            if event.callbacks is not None:
+                event.callbacks.append(self.resume)
+                break
+            # the event was processed already, continue right away
+        self.target = event
+        env.activeProcess = None
+
+
+class AllOf(Event):
+    __slots__ = ('events', 'count')
+
+    def __init__(self, env, events):
+        super().__init__(env)
+        self.events = tuple(events)
+        self.count = 0
+        if not self.events:
+            self.succeed({})
+            return
+        for event in self.events:
+            if event.callbacks is None:
+                self.check(event)
+            else:
+                event.callbacks.append(self.check)
+
+    def check(self, event):
+        if self.value is not PENDING:
+            return
+        self.count += 1
+        if self.count == len(self.events):
+            self.succeed({e: e.value for e in self.events})
+
+
+class Store:
+    """ FIFO store with the put/get semantics of simpy.Store. """
+    def __init__(self, env, capacity=Infinity):
+        if capacity <= 0:
+            raise ValueError('"capacity" must be > 0.')
+        self.env = env
+        self.capacity = capacity
+        self.items = []
+        self.putQueue = []  # (event, item)
+        self.getQueue = []
+
+    def put(self, item):
+        event = Event(self.env)
+        event.callbacks.append(self.trigger_get)
+        self.putQueue.append((event, item))
+        self.trigger_put(None)
+        return event
+
+    def get(self):
+        event = Event(self.env)
+        event.callbacks.append(self.trigger_put)
+        self.getQueue.append(event)
+        self.trigger_get(None)
+        return event
+
+    # Like simpy, each trigger only tries the first waiting request.
+    def trigger_put(self, event):
+        if self.putQueue and len(self.items) < self.capacity:
+            put, item = self.putQueue.pop(0)
+            self.items.append(item)
+            put.succeed()
+
+    def trigger_get(self, event):
+        if self.getQueue and self.items:
+            self.getQueue.pop(0).succeed(self.items.pop(0))
+
+
+class Request(Event):
+    __slots__ = ('resource',)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if self.value is PENDING:
+            self.resource.putQueue.remove(self)
+        if excType is not GeneratorExit:
+            self.resource.release(self)
+        return None
+
+
+class Resource:
+    """ Resource with the request/release semantics of simpy.Resource. """
+    def __init__(self, env, capacity=1):
+        if capacity <= 0:
+            raise ValueError('"capacity" must be > 0.')
+        self.env = env
+        self.capacity = capacity
+        self.users = []
+        self.putQueue = []
+        self.getQueue = []  # (release event, request)
+
+    @property
+    def count(self):
+        return len(self.users)
+
+    def request(self):
+        event = Request(self.env)
+        event.resource = self
+        self.putQueue.append(event)
+        event.callbacks.append(self.trigger_get)
+        self.trigger_put(None)
+        return event
+
+    def release(self, request):
+        event = Event(self.env)
+        self.getQueue.append((event, request))
+        event.callbacks.append(self.trigger_put)
+        self.trigger_get(None)
+        return event
+
+    def trigger_put(self, event):
+        if self.putQueue and len(self.users) < self.capacity:
+            request = self.putQueue.pop(0)
+            self.users.append(request)
+            request.succeed()
+
+    def trigger_get(self, event):
+        if self.getQueue:
+            release, request = self.getQueue.pop(0)
+            if request in self.users:
+                self.users.remove(request)
+            release.succeed()
+
+
+class Environment:
+    """ Event queue and clock, with the same interface as simpy.Environment for what the simulator uses. """
+    def __init__(self, initial_time=0):
+        self.now = initial_time
+        self.queue = []
+        self.eid = itertools.count()
+        self.activeProcess = None
+
+    @property
+    def active_process(self):
+        return self.activeProcess
+
+    def schedule(self, event, priority=NORMAL, delay=0):
+        heapq.heappush(self.queue, (self.now + delay, priority, next(self.eid), event))
+
+    def process(self, generator):
+        return Process(self, generator)
+
+    def timeout(self, delay=0, value=None):
+        return Timeout(self, delay, value)
+
+    def event(self):
+        return Event(self)
+
+    def all_of(self, events):
+        return AllOf(self, events)
+
+    def peek(self):
+        return self.queue[0][0] if self.queue else Infinity
+
+    def run(self, until=None):
+        stop = None
+        if until is not None:
+            at = until if isinstance(until, int) else float(until)
+            if at <= self.now:
+                raise ValueError(f'until ({at}) must be greater than the current simulation time')
+            # before all regular events at that time, like in simpy
+            stop = Event(self)
+            stop.value = None
+            self.schedule(stop, URGENT, at - self.now)
+        queue = self.queue
+        pop = heapq.heappop
+        while queue:
+            self.now, _, _, event = pop(queue)
+            if event is stop:
+                return None
+            callbacks, event.callbacks = event.callbacks, None
+            for callback in callbacks:
+                callback(event)
+        if stop is not None:
+            raise RuntimeError(f'No scheduled events left but "until" event was not triggered: {until}')
+        return None
+
+
+def make_environment(engine='simpy'):
+    """ A new environment of the given engine: 'simpy', or 'fast' for this kernel. """
+    if engine == 'simpy':
+        return simpy.Environment()
+    if engine == 'fast':
+        return Environment()
+    raise ValueError(f'Unknown engine {engine}, must be one of: {", ".join(ENGINES)}')
+
+
+def make_store(env, capacity=Infinity):
+    if isinstance(env, Environment):
+        return Store(env, capacity)
+    return simpy.Store(env, capacity=capacity)
+
+
+def make_resource(env, capacity=1):
+    if isinstance(env, Environment):
+        return Resource(env, capacity)
+    return simpy.Resource(env, capacity)
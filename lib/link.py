@@ -0,0 +1,133 @@
+import numpy as np
+
+from lib.common import search_radius
+from lib.phy import estimate_path_loss, modem_profile
+from lib.spatial import SpatialGrid
+
+
+class LinkBudget:
+    """
+    Path loss, RSSI and sensing/CAD reachability between every pair of nodes.
+    Row i holds what a transmission of node i looks like at every receiver, so a
+    packet only has to copy out the row of its transmitter instead of evaluating
+    the path loss model for each receiver again.
+    The matrices are built lazily on first use, i.e. after the asymmetric link
+    offsets have been drawn. When a node moves, only its row and column are
+    marked dirty and recomputed on the next read.
+    It also keeps a spatial grid of the node positions (nodes add themselves
+    when they are placed) for radius queries such as random placement.
+    """
+    def __init__(self, conf, nodes):
+        self.conf = conf
+        self.nodes = nodes
+        self.built = False
+        self.dirty = set()
+        self.neighborCache = {}
+        self.cadNeighborCache = {}
+        self.grid = SpatialGrid(search_radius(conf, 2 * conf.GL))
+        self.pathLoss = None
+        self.rssi = None
+        self.sensed = None
+        self.detected = None
+
+    def node_moved(self, nodeid):
+        self.dirty.add(nodeid)
+        self.grid.move(nodeid, self.nodes[nodeid].x, self.nodes[nodeid].y)
+
+    def nodes_moved(self, nodeids):
+        """ Like node_moved for an array of node ids. """
+        self.dirty.update(nodeids.tolist())
+        for nodeid in nodeids.tolist():
+            self.grid.move(nodeid, self.nodes[nodeid].x, self.nodes[nodeid].y)
+
+    def build(self):
+        conf = self.conf
+        self.x = np.array([n.x for n in self.nodes], dtype=float)
+        self.y = np.array([n.y for n in self.nodes], dtype=float)
+        self.z = np.array([n.z for n in self.nodes], dtype=float)
+        self.gain = np.array([n.antennaGain for n in self.nodes], dtype=float)
+        nrNodes = len(self.nodes)
+
+        self.offset = np.zeros((nrNodes, nrNodes))
+        for (tx, rx), value in conf.LINK_OFFSET.items():
+            if tx < nrNodes and rx < nrNodes:
+                self.offset[tx, rx] = value
+
+        self.pathLoss = self.path_loss(np.arange(nrNodes)[:, None], np.arange(nrNodes)[None, :])
+        self.rssi = conf.PTX + self.gain[:, None] - self.pathLoss
+        profile = modem_profile(conf)
+        self.sensed = self.rssi >= profile.sensitivity
+        self.detected = self.rssi >= profile.cadThreshold
+        self.clear_diagonal()
+        self.built = True
+        self.dirty.clear()
+        self.neighborCache.clear()
+        self.cadNeighborCache.clear()
+
+    def path_loss(self, tx, rx):
+        """ Path loss including the link offset from the nodes with index array tx to those in rx (broadcasted). """
+        dist_3d = np.sqrt(np.abs(self.x[tx] - self.x[rx]) ** 2 + np.abs(self.y[tx] - self.y[rx]) ** 2 + np.abs(self.z[tx] - self.z[rx]) ** 2)
+        return estimate_path_loss(self.conf, dist_3d, self.conf.FREQ, self.z[tx], self.z[rx]) + self.offset[tx, rx]
+
+    def update(self):
+        """ Recompute the rows and columns of the nodes that moved since the last read. """
+        conf = self.conf
+        moved = np.fromiter(sorted(self.dirty), dtype=int, count=len(self.dirty))
+        if 2 * len(moved) >= len(self.nodes):
+            # cheaper to recompute everything than the rows and columns of most nodes
+            self.build()
+            return
+        self.dirty.clear()
+        # the columns change as well, so every neighbor list may be outdated
+        self.neighborCache.clear()
+        self.cadNeighborCache.clear()
+        for i in moved:
+            self.x[i] = self.nodes[i].x
+            self.y[i] = self.nodes[i].y
+            self.z[i] = self.nodes[i].z
+        everyone = np.arange(len(self.nodes))
+
+        # transmissions of the moved nodes
+        self.pathLoss[moved, :] = self.path_loss(moved[:, None], everyone[None, :])
+        self.rssi[moved, :] = conf.PTX + self.gain[moved, None] - self.pathLoss[moved, :]
+        # transmissions towards the moved nodes
+        self.pathLoss[:, moved] = self.path_loss(everyone[:, None], moved[None, :])
+        self.rssi[:, moved] = conf.PTX + self.gain[:, None] - self.pathLoss[:, moved]
+
+        profile = modem_profile(conf)
+        self.sensed[moved, :] = self.rssi[moved, :] >= profile.sensitivity
+        self.sensed[:, moved] = self.rssi[:, moved] >= profile.sensitivity
+        self.detected[moved, :] = self.rssi[moved, :] >= profile.cadThreshold
+        self.detected[:, moved] = self.rssi[:, moved] >= profile.cadThreshold
+        self.clear_diagonal()
+
+    def clear_diagonal(self):
+        # a node does not receive its own transmissions
+        np.fill_diagonal(self.pathLoss, 0)
+        np.fill_diagonal(self.rssi, 0)
+        np.fill_diagonal(self.sensed, False)
+        np.fill_diagonal(self.detected, False)
+
+    def row(self, txNodeId):
+        """ Path loss, RSSI, sensed and detected flags of a transmission by txNodeId at every node. """
+        if not self.built:
+            self.build()
+        elif self.dirty:
+            self.update()
+        return self.pathLoss[txNodeId], self.rssi[txNodeId], self.sensed[txNodeId], self.detected[txNodeId]
+
+    def neighbors(self, txNodeId):
+        """ Sorted ids of the nodes that can sense a transmission by txNodeId. Do not modify the returned array. """
+        if not self.built or self.dirty:
+            self.row(txNodeId)
+        if txNodeId not in self.neighborCache:
+            self.neighborCache[txNodeId] = np.flatnonzero(self.sensed[txNodeId])
+        return self.neighborCache[txNodeId]
+
+    def cad_neighbors(self, txNodeId):
+        """ Sorted ids of the nodes that detect a transmission by txNodeId with CAD. Do not modify the returned array. """
+        if not self.built or self.dirty:
+            self.row(txNodeId)
+        if txNodeId not in self.cadNeighborCache:
+            self.cadNeighborCache[txNodeId] = np.flatnonzero(self.detected[txNodeId])
+        return self.cadNeighborCache[txNodeId]
@@ -1,5 +1,5 @@
 import random
-from lib.phy import airtime, SLOT_TIME
+from lib.phy import modem_profile
 
 
 VERBOSE = False
@@ -14,10 +14,10 @@ def verboseprint(*args, **kwargs):
 
 
 def set_transmit_delay(node, packet):  # from RadioLibInterface::setTransmitDelay
-    for p in reversed(node.packetsAtN[node.nodeid]):
-        if p.seq == packet.seq and p.rssiAtN[node.nodeid] != 0 and p.receivedAtN[node.nodeid] is True:
-            # verboseprint(round(self.env.now, 3), 'Pick delay with RSSI of node', self.nodeid, 'is', p.rssiAtN[self.nodeid])
-            return get_tx_delay_msec_weighted(node, p.rssiAtN[node.nodeid])  # weighted waiting based on RSSI
+    rssi = node.lastRxRssi.get(packet.seq)
+    if rssi is not None:
+        # verboseprint(round(self.env.now, 3), 'Pick delay with RSSI of node', self.nodeid, 'is', rssi)
+        return get_tx_delay_msec_weighted(node, rssi)  # weighted waiting based on RSSI
     return get_tx_delay_msec(node)
 
 
@@ -38,7 +38,7 @@ def get_tx_delay_msec_weighted(node, rssi):  # from RadioInterface::getTxDelayMs
     else:
         CW = random.randint(0, 2 ** CWsize - 1)
     verboseprint(f'Node {node.nodeid} has CW size {CWsize} and picked CW {CW}')
-    return CW * SLOT_TIME
+    return CW * modem_profile(node.conf).slotTime
 
 
 def get_tx_delay_msec(node):  # from RadioInterface::getTxDelayMsec
@@ -46,11 +46,12 @@ def get_tx_delay_msec(node):  # from RadioInterface::getTxDelayMsec
     CWsize = int(channelUtil * (CWmax - CWmin) / 100 + CWmin)
     CW = random.randint(0, 2 ** CWsize - 1)
     verboseprint(f'Current channel utilization is {channelUtil}, so picked CW {CW}')
-    return CW * SLOT_TIME
+    return CW * modem_profile(node.conf).slotTime
 
 
 def get_retransmission_msec(node, packet):  # from RadioInterface::getRetransmissionMsec
-    packetAirtime = int(airtime(node.conf, node.conf.SFMODEM[node.conf.MODEM], node.conf.CRMODEM[node.conf.MODEM], packet.packetLen, node.conf.BWMODEM[node.conf.MODEM]))
+    profile = modem_profile(node.conf)
+    packetAirtime = int(profile.airtime(packet.packetLen))
     channelUtil = node.airUtilization / node.env.now * 100
     CWsize = int(channelUtil * (CWmax - CWmin) / 100 + CWmin)
-    return 2 * packetAirtime + (2 ** CWsize + 2 ** (int((CWmax + CWmin) / 2))) * SLOT_TIME + PROCESSING_TIME_MSEC
+    return 2 * packetAirtime + (2 ** CWsize + 2 ** (int((CWmax + CWmin) / 2))) * profile.slotTime + PROCESSING_TIME_MSEC
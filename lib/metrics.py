@@ -0,0 +1,194 @@
+import math
+
+import numpy as np
+
+from lib.packet import count_receivers
+
+
+class RunningStats:
+    """ Count, mean and variance of a stream of values (Welford's algorithm), without storing them. """
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def average(self):
+        return self.mean if self.count else math.nan
+
+    def variance(self):
+        # population variance, like np.var
+        return self.m2 / self.count if self.count else math.nan
+
+    def std(self):
+        return math.sqrt(self.variance())
+
+
+def summarize(nrNodes, nrMessages, packets, collisions, sensed, received, useful, meanDelay):
+    """ The end-of-run statistics from the totals; rates are fractions and NaN if undefined. """
+    return {
+        'packets': packets,
+        'collisions': collisions,
+        'sensed': sensed,
+        'received': received,
+        'useful': useful,
+        'meanDelay': meanDelay,
+        'collisionRate': collisions / sensed if sensed else math.nan,
+        # fraction of the other nodes reached per message
+        'reachability': useful / (nrMessages * (nrNodes - 1)) if nrMessages and nrNodes > 1 else math.nan,
+        # fraction of the received packets that brought a message to a node for the first time
+        'usefulness': useful / received if received else math.nan,
+    }
+
+
+class PacketLog:
+    """
+    Finished packets in columnar form: one row per packet in a NumPy structured array
+    (see PACKET_DTYPE) and, per receiver flag, a matrix with one bit per node (packed
+    with np.packbits). Rows are stored in fixed-size chunks that are never resized.
+    The end-of-run statistics, plot_schedule and the packet CSV of sim_report are
+    computed from these arrays instead of from the packet objects.
+    """
+    PACKET_DTYPE = np.dtype([
+        ('txNodeId', np.int32),
+        ('origTxNodeId', np.int32),
+        ('seq', np.int64),
+        ('genTime', np.float64),
+        ('startTime', np.float64),
+        ('endTime', np.float64),
+        ('timeOnAir', np.float64),
+        ('hopLimit', np.int16),
+        ('isAck', np.bool_),
+    ])
+    FLAGS = {'sensed': 'sensedByN', 'collided': 'collidedAtN', 'received': 'receivedAtN'}
+
+    def __init__(self, nrNodes, chunkRows=4096):
+        self.nrNodes = nrNodes
+        self.chunkRows = chunkRows
+        self.chunks = []  # (records, {flag: packed bits})
+        self.filled = 0  # rows used in the last chunk
+
+    def __len__(self):
+        if not self.chunks:
+            return 0
+        return (len(self.chunks) - 1) * self.chunkRows + self.filled
+
+    def record(self, packet):
+        if not self.chunks or self.filled == self.chunkRows:
+            records = np.zeros(self.chunkRows, dtype=self.PACKET_DTYPE)
+            bits = {flag: np.zeros((self.chunkRows, (self.nrNodes + 7) // 8), dtype=np.uint8) for flag in self.FLAGS}
+            self.chunks.append((records, bits))
+            self.filled = 0
+        records, bits = self.chunks[-1]
+        records[self.filled] = (packet.txNodeId, packet.origTxNodeId, packet.seq, packet.genTime, packet.startTime,
+                                packet.endTime, packet.timeOnAir, packet.hopLimit, packet.isAck)
+        for flag, attribute in self.FLAGS.items():
+            bits[flag][self.filled] = np.packbits(np.asarray(getattr(packet, attribute), dtype=bool))
+        self.filled += 1
+
+    def parts(self):
+        """ The filled part of every chunk, as (records, {flag: packed bits}). """
+        for i, (records, bits) in enumerate(self.chunks):
+            rows = self.filled if i == len(self.chunks) - 1 else self.chunkRows
+            yield records[:rows], {flag: matrix[:rows] for flag, matrix in bits.items()}
+
+    def column(self, name):
+        return np.concatenate([records[name] for records, _ in self.parts()] or [np.zeros(0, dtype=self.PACKET_DTYPE[name])])
+
+    def flags(self, flag):
+        """ Boolean matrix of one flag with a row per packet and a column per node. """
+        return np.concatenate([np.unpackbits(bits[flag], axis=1, count=self.nrNodes).astype(bool) for _, bits in self.parts()]
+                              or [np.zeros((0, self.nrNodes), dtype=bool)])
+
+    def table(self):
+        """ The packet columns plus the number of nodes per flag, e.g. for a CSV. """
+        table = {name: self.column(name) for name in self.PACKET_DTYPE.names}
+        for flag in self.FLAGS:
+            table['nr' + flag.capitalize()] = np.concatenate(
+                [np.unpackbits(bits[flag], axis=1).sum(axis=1) for _, bits in self.parts()] or [np.zeros(0, dtype=int)])
+        return table
+
+    def summary(self, nrMessages):
+        collisions = sensed = received = 0
+        delaySum = 0.0
+        firstReceptions = []
+        for records, bits in self.parts():
+            collisions += int(np.unpackbits(bits['collided']).sum())
+            sensed += int(np.unpackbits(bits['sensed']).sum())
+            receivedAt = np.unpackbits(bits['received'], axis=1, count=self.nrNodes)
+            perPacket = receivedAt.sum(axis=1)
+            received += int(perPacket.sum())
+            # every reception ends at the end of the packet
+            delaySum += float((perPacket * (records['endTime'] - records['genTime'])).sum())
+            rows, rxs = np.nonzero(receivedAt)
+            fromOthers = rxs != records['origTxNodeId'][rows]
+            firstReceptions.append(records['seq'][rows[fromOthers]] * self.nrNodes + rxs[fromOthers])
+        # a node learns about a message once, no matter how many copies it receives
+        useful = len(np.unique(np.concatenate(firstReceptions))) if firstReceptions else 0
+        meanDelay = delaySum / received if received else math.nan
+        return summarize(self.nrNodes, nrMessages, len(self), collisions, sensed, received, useful, meanDelay)
+
+
+class MetricsCollector:
+    """
+    End-of-run statistics, collected while the simulation runs so that finished
+    packets do not have to stay in memory. Receptions are counted by the nodes as
+    they happen. The packet registry folds in the collision and sensing flags of a
+    packet once it is off the air, and those of the remaining packets at the end.
+    With a PacketLog, finished packets are recorded in it as well and the summary
+    is computed from the log. Without one, the messages each node received from
+    others are marked in a bitmap per node, indexed by sequence number, so the
+    useful receptions are counted the same way as from the log, independent of how
+    long the nodes remember sequence numbers (PACKET_HISTORY_SIZE and _EXPIRY).
+    The registry tells when no packet carries the oldest sequence numbers anymore,
+    and their bits are dropped, so the bitmaps only span the recent messages.
+    """
+    def __init__(self, log=None):
+        self.log = log
+        self.packets = 0
+        self.collisions = 0
+        self.sensed = 0
+        self.received = 0
+        self.useful = 0
+        self.delivered = {}  # nodeid -> bytearray with one bit per sequence number from base on
+        self.base = 0
+        self.delay = RunningStats()
+
+    def add_packet(self, packet):
+        self.packets += 1
+        self.collisions += count_receivers(packet.collidedAtN)
+        self.sensed += count_receivers(packet.sensedByN)
+        if self.log is not None:
+            self.log.record(packet)
+
+    def add_reception(self, packet, now, nodeid):
+        self.received += 1
+        self.delay.add(now - packet.genTime)
+        if self.log is None and packet.origTxNodeId != nodeid:
+            # a node learns about a message once, no matter how many copies it receives
+            delivered = self.delivered.setdefault(nodeid, bytearray())
+            byte, bit = divmod(packet.seq - self.base, 8)
+            if byte >= len(delivered):
+                delivered.extend(bytes(max(byte + 1 - len(delivered), len(delivered))))
+            if not delivered[byte] & (1 << bit):
+                delivered[byte] |= 1 << bit
+                self.useful += 1
+
+    def forget_before(self, seq):
+        """ Drop the bits of the sequence numbers below seq, of which no packet is left. """
+        drop = (seq - self.base) // 8
+        if drop <= 0:
+            return
+        for delivered in self.delivered.values():
+            del delivered[:drop]
+        self.base += 8 * drop
+
+    def summary(self, nodes, nrMessages):
+        if self.log is not None:
+            return self.log.summary(nrMessages)
+        return summarize(len(nodes), nrMessages, self.packets, self.collisions, self.sensed, self.received, self.useful, self.delay.average())
@@ -0,0 +1,83 @@
+import math
+
+import numpy as np
+
+from lib.phy import modem_profile
+
+
+class MobilityEngine:
+    """
+    Moves all mobile nodes from one process instead of with a move_node process per
+    node. The positions, speeds, next move times and last broadcast positions of the
+    moving nodes are kept in NumPy arrays. Like move_node, each node moves right
+    away and then after exponentially distributed intervals with a mean of one
+    minute, each time a random distance of up to its speed per minute in a random
+    direction, clamped to the area. The process wakes up at the earliest next move,
+    moves the nodes that are due, reports them to the link budget in one call and
+    asks the GPS nodes among them that crossed the smart position distance and time
+    thresholds to broadcast.
+    The nodes decide themselves whether they move (MeshNode sets isMoving,
+    gpsEnabled and movementStepSize), so the same nodes move as without the engine,
+    but the paths and move times are drawn from a NumPy generator seeded with
+    conf.SEED, so they differ from those of move_node.
+    """
+    def __init__(self, conf, env, nodes, links):
+        self.conf = conf
+        self.env = env
+        self.nodes = nodes
+        self.links = links
+        self.rng = np.random.default_rng(conf.SEED)
+        moving = [n for n in nodes if n.isMoving]
+        self.nodeIds = np.array([n.nodeid for n in moving], dtype=int)
+        self.x = np.array([n.x for n in moving], dtype=float)
+        self.y = np.array([n.y for n in moving], dtype=float)
+        self.speed = np.array([n.movementStepSize for n in moving], dtype=float)  # meters per minute
+        self.gpsEnabled = np.array([n.gpsEnabled for n in moving], dtype=bool)
+        self.lastBroadcastX = np.array([n.lastBroadcastX for n in moving], dtype=float)
+        self.lastBroadcastY = np.array([n.lastBroadcastY for n in moving], dtype=float)
+        self.lastBroadcastTime = np.array([n.lastBroadcastTime for n in moving], dtype=float)
+        self.bounds = (conf.OX - conf.XSIZE / 2, conf.OX + conf.XSIZE / 2, conf.OY - conf.YSIZE / 2, conf.OY + conf.YSIZE / 2)
+        # like get_next_time, a node stops moving when a position broadcast could not be flooded before the end
+        airtime = modem_profile(conf).airtime(conf.PACKETLENGTH)
+        self.lastMove = conf.SIMTIME - np.array([n.hopLimit for n in moving], dtype=float) * airtime
+        self.nextMove = np.zeros(len(moving))
+        if len(self.nodeIds) > 0:
+            env.process(self.run())
+
+    def run(self):
+        while True:
+            nextMove = self.nextMove.min()
+            if math.isinf(nextMove):
+                break
+            yield self.env.timeout(nextMove - self.env.now)
+            due = np.flatnonzero(self.nextMove <= self.env.now)
+            self.move(due)
+            self.broadcast_positions(due)
+            # the next move of each node after an exponential interval, unless that is too close to the end
+            nextMove = self.env.now + self.rng.exponential(self.conf.ONE_MIN_INTERVAL, len(due))
+            self.nextMove[due] = np.where(nextMove < self.lastMove[due], nextMove, math.inf)
+
+    def move(self, due):
+        """ Move the nodes at the indices due once. """
+        count = len(due)
+        angle = 2 * math.pi * self.rng.random(count)
+        distance = self.speed[due] * self.rng.random(count)
+        left, right, bottom, top = self.bounds
+        self.x[due] = np.clip(self.x[due] + distance * np.cos(angle), left, right)
+        self.y[due] = np.clip(self.y[due] + distance * np.sin(angle), bottom, top)
+        for nodeId, x, y in zip(self.nodeIds[due].tolist(), self.x[due].tolist(), self.y[due].tolist()):
+            self.nodes[nodeId].x = x
+            self.nodes[nodeId].y = y
+        self.links.nodes_moved(self.nodeIds[due])
+
+    def broadcast_positions(self, due):
+        """ Let the GPS nodes among due that moved far enough since their last broadcast, long enough ago, send their position. """
+        now = self.env.now
+        ready = (self.gpsEnabled[due]
+                 & (np.hypot(self.x[due] - self.lastBroadcastX[due], self.y[due] - self.lastBroadcastY[due]) >= self.conf.SMART_POSITION_DISTANCE_THRESHOLD)
+                 & (now - self.lastBroadcastTime[due] >= self.conf.SMART_POSITION_DISTANCE_MIN_TIME))
+        for i in due[ready]:
+            if self.nodes[self.nodeIds[i]].broadcast_position():
+                self.lastBroadcastX[i] = self.x[i]
+                self.lastBroadcastY[i] = self.y[i]
+                self.lastBroadcastTime[i] = now
@@ -1,17 +1,18 @@
 #!/usr/bin/env python3
+import collections
 import math
 import random
 
-import simpy
-
 from lib.common import calc_dist, find_random_position
+from lib.kernel import make_resource
 from lib.mac import set_transmit_delay, get_retransmission_msec
-from lib.phy import check_collision, is_channel_active, airtime
-from lib.packet import NODENUM_BROADCAST, MeshPacket, MeshMessage
+from lib.phy import check_collision, is_channel_active, modem_profile
+from lib.packet import NODENUM_BROADCAST, ActivePackets, MeshPacket, MeshMessage, PacketHistory
+from lib.trace import GENERATED, RETRANSMITTED, TX_STARTED, TX_CANCELLED, RX_STARTED, RX_MISSED, RX_DECODED, RX_FAILED
 
 
 class MeshNode:
-    def __init__(self, conf, nodes, env, bc_pipe, nodeid, period, messages, packetsAtN, packets, delays, nodeConfig, messageSeq, verboseprint):
+    def __init__(self, conf, nodes, links, env, bc_pipe, nodeid, period, messages, packetsAtN, packets, metrics, nodeConfig, messageSeq, verboseprint, trace=None):
         self.conf = conf
         self.nodeid = nodeid
         self.verboseprint = verboseprint
@@ -28,25 +29,36 @@ class MeshNode:
             self.hopLimit = nodeConfig['hopLimit']
             self.antennaGain = nodeConfig['antennaGain']
         else:
-            self.x, self.y = find_random_position(self.conf, nodes)
+            self.x, self.y = find_random_position(self.conf, nodes, links.grid)
             self.z = self.conf.HM
             self.isRouter = self.conf.router
             self.isRepeater = False
             self.isClientMute = False
             self.hopLimit = self.conf.hopLimit
             self.antennaGain = self.conf.GL
+        links.grid.insert(self.nodeid, self.x, self.y)
         self.messageSeq = messageSeq
         self.env = env
         self.period = period
         self.bc_pipe = bc_pipe
         self.nodes = nodes
+        self.links = links
         self.messages = messages
         self.packetsAtN = packetsAtN
         self.nrPacketsSent = 0
         self.packets = packets
-        self.delays = delays
-        self.timesReceived = {}
+        self.metrics = metrics
+        # optional TraceRecorder (lib/trace.py)
+        self.trace = trace
+        # how often this node heard each recent sequence number, for duplicate suppression
+        self.packetHistory = PacketHistory(self.conf.PACKET_HISTORY_SIZE, self.conf.PACKET_HISTORY_EXPIRY)
+        # RSSI of the last received copy per sequence number, for the SNR-based contention window
+        self.lastRxRssi = collections.OrderedDict()
         self.isReceiving = []
+        # packets on the air that this node can detect with CAD, registered by their transmitter
+        self.channelActivity = ActivePackets()
+        # with CHANNEL_IDLE_WAKEUP, triggered when the last packet in channelActivity has ended
+        self.channelIdle = None
         self.isTransmitting = False
         self.usefulPackets = 0
         self.txAirUtilization = 0
@@ -59,16 +71,16 @@ class MeshNode:
         self.lastBroadcastX = self.x
         self.lastBroadcastY = self.y
         self.lastBroadcastTime = 0
-        # track total transmit time for the last 6 buckets (each is 10s in firmware logic)
-        self.channelUtilization = [0] * self.conf.CHANNEL_UTILIZATION_PERIODS  # each entry is ms spent on air in that interval
-        self.channelUtilizationIndex = 0  # which "bucket" is current
-        self.prevTxAirUtilization = 0.0   # how much total tx air-time had been used at last sample
+        # channel utilization over the last 6 buckets of 10s (as in the firmware), computed when asked
+        # from the cumulative tx airtime after each recent transmission instead of by a ticker
+        self.utilizationStart = env.now  # bucket boundaries are at utilizationStart + k * TEN_SECONDS_INTERVAL
+        self.txAirtimeHistory = collections.deque()  # (time, txAirUtilization after the transmission)
+        self.txAirtimeBase = 0.0  # txAirUtilization before the oldest entry of the history
 
-        env.process(self.track_channel_utilization(env))
         if not self.isRepeater:  # repeaters don't generate messages themselves
             env.process(self.generate_message())
-        env.process(self.receive(self.bc_pipe.get_output_conn()))
-        self.transmitter = simpy.Resource(env, 1)
+        env.process(self.receive(self.bc_pipe.get_output_conn(self.nodeid)))
+        self.transmitter = make_resource(env, 1)
 
         # start mobility if enabled
         if self.conf.MOVEMENT_ENABLED and self.moveRng.random() <= self.conf.APPROX_RATIO_NODES_MOVING:
@@ -84,33 +96,43 @@ class MeshNode:
             ]
             self.movementStepSize = self.moveRng.choice(possibleSpeeds)
 
-            env.process(self.move_node(env))
-
-    def track_channel_utilization(self, env):
-        """
-        Periodically compute how many seconds of airtime this node consumed
-        over the last 10-second block and store it in the ring buffer.
-        """
-        while True:
-            # Wait 10 seconds of simulated time
-            yield env.timeout(self.conf.TEN_SECONDS_INTERVAL)
-
-            curTotalAirtime = self.txAirUtilization  # total so far, in *milliseconds*
-            blockAirtimeMs = curTotalAirtime - self.prevTxAirUtilization
-
-            self.channelUtilization[self.channelUtilizationIndex] = blockAirtimeMs
-
-            self.prevTxAirUtilization = curTotalAirtime
-            self.channelUtilizationIndex = (self.channelUtilizationIndex + 1) % self.conf.CHANNEL_UTILIZATION_PERIODS
+            if not self.conf.MOBILITY_ENGINE:  # otherwise moved by lib/mobility.py
+                env.process(self.move_node(env))
+
+    def record_tx_airtime(self, timeOnAir):
+        self.txAirUtilization += timeOnAir
+        self.txAirtimeHistory.append((self.env.now, self.txAirUtilization))
+        # only the buckets of the last minute are ever needed
+        horizon = self.env.now - (self.conf.CHANNEL_UTILIZATION_PERIODS + 1) * self.conf.TEN_SECONDS_INTERVAL
+        while self.txAirtimeHistory[0][0] < horizon:
+            self.txAirtimeBase = self.txAirtimeHistory.popleft()[1]
+
+    def tx_airtime_at(self, time):
+        """ Total tx airtime (ms) of the transmissions started at or before time. """
+        total = self.txAirtimeBase
+        for txTime, cumulative in self.txAirtimeHistory:
+            if txTime > time:
+                break
+            total = cumulative
+        return total
 
     def channel_utilization_percent(self) -> float:
         """
         Returns how much of the last 60 seconds (6 x 10s) this node spent transmitting, as a percent.
         """
-        sumMs = sum(self.channelUtilization)
+        periods = self.conf.CHANNEL_UTILIZATION_PERIODS
+        interval = self.conf.TEN_SECONDS_INTERVAL
+        # bucket (k-1) % periods holds the airtime between the (k-1)th and kth completed interval,
+        # summed in bucket order like the ring buffer of the firmware
+        ticks = int((self.env.now - self.utilizationStart) // interval)
+        buckets = [0] * periods
+        for k in range(max(1, ticks - periods + 1), ticks + 1):
+            prevTotal = self.tx_airtime_at(self.utilizationStart + (k - 1) * interval) if k > 1 else 0.0
+            buckets[(k - 1) % periods] = self.tx_airtime_at(self.utilizationStart + k * interval) - prevTotal
+        sumMs = sum(buckets)
         # 6 intervals, each 10 seconds = 60,000 ms total
         # fraction = sum_ms / 60000, then multiply by 100 for percent
-        return (sumMs / (self.conf.CHANNEL_UTILIZATION_PERIODS * self.conf.TEN_SECONDS_INTERVAL)) * 100.0
+        return (sumMs / (periods * interval)) * 100.0
 
     def move_node(self, env):
         while True:
@@ -135,19 +157,13 @@ class MeshNode:
             # Update node’s position
             self.x = new_x
             self.y = new_y
+            self.links.node_moved(self.nodeid)
 
             if self.gpsEnabled:
                 distanceTraveled = calc_dist(self.lastBroadcastX, self.x, self.lastBroadcastY, self.y)
                 timeElapsed = env.now - self.lastBroadcastTime
                 if distanceTraveled >= self.conf.SMART_POSITION_DISTANCE_THRESHOLD and timeElapsed >= self.conf.SMART_POSITION_DISTANCE_MIN_TIME:
-                    currentUtil = self.channel_utilization_percent()
-                    if currentUtil < 25.0:
-                        self.send_packet(NODENUM_BROADCAST, "POSITION")
-                        self.lastBroadcastX = self.x
-                        self.lastBroadcastY = self.y
-                        self.lastBroadcastTime = env.now
-                    else:
-                        self.verboseprint(f"At time {env.now} node {self.nodeid} SKIPS POSITION broadcast (util={currentUtil:.1f}% > 25%)")
+                    self.broadcast_position()
 
             # Wait until next move
             nextMove = self.get_next_time(self.conf.ONE_MIN_INTERVAL)
@@ -156,13 +172,27 @@ class MeshNode:
             else:
                 break
 
+    def broadcast_position(self):
+        """ Broadcast the current position unless the channel is busy; returns whether it was sent. """
+        currentUtil = self.channel_utilization_percent()
+        if currentUtil < 25.0:
+            self.send_packet(NODENUM_BROADCAST, "POSITION")
+            self.lastBroadcastX = self.x
+            self.lastBroadcastY = self.y
+            self.lastBroadcastTime = self.env.now
+            return True
+        self.verboseprint(f"At time {self.env.now} node {self.nodeid} SKIPS POSITION broadcast (util={currentUtil:.1f}% > 25%)")
+        return False
+
     def send_packet(self, destId, type=""):
         # increment the shared counter
         self.messageSeq["val"] += 1
         messageSeq = self.messageSeq["val"]
         self.messages.append(MeshMessage(self.nodeid, destId, self.env.now, messageSeq))
-        p = MeshPacket(self.conf, self.nodes, self.nodeid, destId, self.nodeid, self.conf.PACKETLENGTH, messageSeq, self.env.now, True, False, None, self.env.now, self.verboseprint)
+        p = MeshPacket(self.conf, self.packets, self.nodeid, destId, self.nodeid, self.conf.PACKETLENGTH, messageSeq, self.env.now, True, False, None, self.env.now)
         self.verboseprint(round(self.env.now, 3), 'Node', self.nodeid, 'generated', type, 'message', p.seq, 'to', destId)
+        if self.trace is not None:
+            self.trace.record(self.env.now, GENERATED, self.nodeid, p)
         self.packets.append(p)
         self.env.process(self.transmit(p))
         return p
@@ -170,25 +200,35 @@ class MeshNode:
     def get_next_time(self, period):
         nextGen = self.nodeRng.expovariate(1.0 / float(period))
         # do not generate message near the end of the simulation (otherwise flooding cannot finish in time)
-        if self.env.now+nextGen + self.hopLimit * airtime(self.conf, self.conf.SFMODEM[self.conf.MODEM], self.conf.CRMODEM[self.conf.MODEM], self.conf.PACKETLENGTH, self.conf.BWMODEM[self.conf.MODEM]) < self.conf.SIMTIME:
+        if self.env.now+nextGen + self.hopLimit * modem_profile(self.conf).airtime(self.conf.PACKETLENGTH) < self.conf.SIMTIME:
             return nextGen
         return -1
     
 
+    def remember_rssi(self, packet):
+        rssi = packet.rssiAtN[self.nodeid]
+        if rssi == 0:
+            return
+        self.lastRxRssi[packet.seq] = rssi
+        self.lastRxRssi.move_to_end(packet.seq)
+        if len(self.lastRxRssi) > self.conf.RX_RSSI_HISTORY:
+            self.lastRxRssi.popitem(last=False)
+
     def was_seen_recently(self, packet, ownTransmit=False):
-        if packet.seq not in self.timesReceived:
-            # First time we know about this packet
-            self.timesReceived[packet.seq] = 0 if ownTransmit else 1
+        if self.packetHistory.get(packet.seq, self.env.now) is None:
+            # First time we know about this packet (or it was forgotten since)
+            self.packetHistory.add(packet.seq, 0 if ownTransmit else 1, self.env.now)
             if not ownTransmit:
                 self.usefulPackets += 1
         else:
-            self.timesReceived[packet.seq] += 0 if ownTransmit else 1
+            self.packetHistory.increment(packet.seq, 0 if ownTransmit else 1)
 
 
     def perhaps_cancel_dupe(self, packet):
         # Cancel if we've already seen this sequence number
-        if packet.seq in self.timesReceived:
-            return self.timesReceived[packet.seq] > 2 if self.isRouter or self.isRepeater else self.timesReceived[packet.seq] > 1
+        timesReceived = self.packetHistory.get(packet.seq, self.env.now)
+        if timesReceived is not None:
+            return timesReceived > 2 if self.isRouter or self.isRepeater else timesReceived > 1
         return False
 
 
@@ -211,22 +251,18 @@ class MeshNode:
                     retransmissionMsec = get_retransmission_msec(self, p)
                     yield self.env.timeout(retransmissionMsec)
 
-                    ackReceived = False  # check whether you received an ACK on the transmitted message
-                    minRetransmissions = self.conf.maxRetransmission
-                    for packetSent in self.packets:
-                        if packetSent.origTxNodeId == self.nodeid and packetSent.seq == p.seq:
-                            if packetSent.retransmissions < minRetransmissions:
-                                minRetransmissions = packetSent.retransmissions
-                            if packetSent.ackReceived:
-                                ackReceived = True
+                    # check whether you received an ACK on the transmitted message
+                    minRetransmissions, ackReceived = self.packets.retransmission_state(self.nodeid, p.seq, self.conf.maxRetransmission)
                     if ackReceived:
                         self.verboseprint('Node', self.nodeid, 'received ACK on generated message with seq. nr.', p.seq)
                         break
                     else:
                         if minRetransmissions > 0:  # generate new packet with same sequence number
-                            pNew = MeshPacket(self.conf, self.nodes, self.nodeid, p.destId, self.nodeid, p.packetLen, p.seq, p.genTime, p.wantAck, False, None, self.env.now, self.verboseprint)
+                            pNew = MeshPacket(self.conf, self.packets, self.nodeid, p.destId, self.nodeid, p.packetLen, p.seq, p.genTime, p.wantAck, False, None, self.env.now)
                             pNew.retransmissions = minRetransmissions - 1
                             self.verboseprint(round(self.env.now, 3), 'Node', self.nodeid, 'wants to retransmit its generated packet to', destId, 'with seq.nr.', p.seq, 'minRetransmissions', minRetransmissions)
+                            if self.trace is not None:
+                                self.trace.record(self.env.now, RETRANSMITTED, self.nodeid, pNew)
                             self.packets.append(pNew)
                             self.env.process(self.transmit(pNew))
                         else:
@@ -247,6 +283,10 @@ class MeshNode:
             # wait when currently receiving or transmitting, or channel is active
             while any(self.isReceiving) or self.isTransmitting or is_channel_active(self, self.env):
                 self.verboseprint(round(self.env.now, 3), 'Node', self.nodeid, 'is busy Tx-ing', self.isTransmitting, 'or Rx-ing', any(self.isReceiving), 'else channel busy!')
+                if self.conf.CHANNEL_IDLE_WAKEUP and self.channelActivity.overlapping(self.env.now):
+                    # sleep until the last packet we hear has ended (receptions included) and back off from there
+                    self.channelIdle = self.env.event()
+                    yield self.channelIdle
                 txTime = set_transmit_delay(self, packet)
                 yield self.env.timeout(txTime)
             self.verboseprint(round(self.env.now, 3), 'Node', self.nodeid, 'ends waiting')
@@ -256,22 +296,39 @@ class MeshNode:
             if not self.perhaps_cancel_dupe(packet):  # if you did not receive an ACK for this message in the meantime
                 self.verboseprint(round(self.env.now, 3), 'Node', self.nodeid, 'started low level send', packet.seq, 'hopLimit', packet.hopLimit, 'original Tx', packet.origTxNodeId)
                 self.nrPacketsSent += 1
-                for rx_node in self.nodes:
-                    if packet.sensedByN[rx_node.nodeid]:
-                        if check_collision(self.conf, self.env, packet, rx_node.nodeid, self.packetsAtN) == 0:
-                            self.packetsAtN[rx_node.nodeid].append(packet)
                 packet.startTime = self.env.now
                 packet.endTime = self.env.now + packet.timeOnAir
-                self.txAirUtilization += packet.timeOnAir
+                self.packets.transmitted(packet)
+                if self.trace is not None:
+                    self.trace.record(self.env.now, TX_STARTED, self.nodeid, packet)
+                for rx_nodeId in packet.cadNeighbors:
+                    self.nodes[rx_nodeId].channelActivity.add(packet)
+                for rx_nodeId in packet.neighbors:
+                    if packet.sensedByN[rx_nodeId]:
+                        if check_collision(self.conf, self.env, packet, rx_nodeId, self.packetsAtN, self.trace) == 0:
+                            self.packetsAtN[rx_nodeId].add(packet)
+                self.record_tx_airtime(packet.timeOnAir)
                 self.airUtilization += packet.timeOnAir
                 self.bc_pipe.put(packet)
                 self.isTransmitting = True
                 yield self.env.timeout(packet.timeOnAir)
                 self.isTransmitting = False
+                if self.conf.CHANNEL_IDLE_WAKEUP:
+                    for rx_nodeId in packet.cadNeighbors:
+                        if self.nodes[rx_nodeId].channelIdle is not None:
+                            self.nodes[rx_nodeId].channel_released()
             else:  # received ACK: abort transmit, remove from packets generated
                 self.verboseprint(round(self.env.now, 3), 'Node', self.nodeid, 'in the meantime received ACK, abort packet with seq. nr', packet.seq)
+                if self.trace is not None:
+                    self.trace.record(self.env.now, TX_CANCELLED, self.nodeid, packet)
                 self.packets.remove(packet)
 
+    def channel_released(self):
+        """ Called when a packet this node detects has ended while it waits; wakes up transmit once nothing is left on the air. """
+        if not self.channelActivity.overlapping(self.env.now):
+            channelIdle, self.channelIdle = self.channelIdle, None
+            channelIdle.succeed()
+
     def receive(self, in_pipe):
         while True:
             p = yield in_pipe.get()
@@ -280,10 +337,14 @@ class MeshNode:
                     self.verboseprint(round(self.env.now, 3), 'Node', self.nodeid, 'started receiving packet', p.seq, 'from', p.txNodeId)
                     p.onAirToN[self.nodeid] = False
                     self.isReceiving.append(True)
+                    if self.trace is not None:
+                        self.trace.record(self.env.now, RX_STARTED, self.nodeid, p, p.rssiAtN[self.nodeid])
                 else:  # if you were currently transmitting, you could not have sensed it
                     self.verboseprint(round(self.env.now, 3), 'Node', self.nodeid, 'was transmitting, so could not receive packet', p.seq)
                     p.sensedByN[self.nodeid] = False
                     p.onAirToN[self.nodeid] = False
+                    if self.trace is not None:
+                        self.trace.record(self.env.now, RX_MISSED, self.nodeid, p, p.rssiAtN[self.nodeid])
             elif p.sensedByN[self.nodeid]:  # end of reception
                 try:
                     self.isReceiving[self.isReceiving.index(True)] = False
@@ -292,10 +353,15 @@ class MeshNode:
                 self.airUtilization += p.timeOnAir
                 if p.collidedAtN[self.nodeid]:
                     self.verboseprint(round(self.env.now, 3), 'Node', self.nodeid, 'could not decode packet.')
+                    if self.trace is not None:
+                        self.trace.record(self.env.now, RX_FAILED, self.nodeid, p, p.rssiAtN[self.nodeid])
                     continue
                 p.receivedAtN[self.nodeid] = True
+                self.remember_rssi(p)
                 self.verboseprint(round(self.env.now, 3), 'Node', self.nodeid, 'received packet', p.seq, 'with delay', round(self.env.now - p.genTime, 2))
-                self.delays.append(self.env.now - p.genTime)
+                self.metrics.add_reception(p, self.env.now, self.nodeid)
+                if self.trace is not None:
+                    self.trace.record(self.env.now, RX_DECODED, self.nodeid, p, p.rssiAtN[self.nodeid])
 
                 # Update history of received packets
                 self.was_seen_recently(p)
@@ -309,27 +375,24 @@ class MeshNode:
                     p.ackReceived = True
                     continue
 
-                ackReceived = False
                 realAckReceived = False
-                for sentPacket in self.packets:
-                    # check if ACK for message you currently have in queue
-                    if sentPacket.txNodeId == self.nodeid and sentPacket.seq == p.seq:
-                        self.verboseprint(round(self.env.now, 3), 'Node', self.nodeid, 'received implicit ACK for message in queue.')
-                        ackReceived = True
-                        sentPacket.ackReceived = True
-                    # check if real ACK for message sent
-                    if sentPacket.origTxNodeId == self.nodeid and p.isAck and sentPacket.seq == p.requestId:
+                # check if ACK for message you currently have in queue
+                ackReceived = self.packets.acknowledge_tx(self.nodeid, p.seq)
+                if ackReceived:
+                    self.verboseprint(round(self.env.now, 3), 'Node', self.nodeid, 'received implicit ACK for message in queue.')
+                # check if real ACK for message sent
+                if p.isAck:
+                    realAckReceived = self.packets.acknowledge_orig(self.nodeid, p.requestId)
+                    if realAckReceived:
                         self.verboseprint(round(self.env.now, 3), 'Node', self.nodeid, 'received real ACK.')
-                        realAckReceived = True
-                        sentPacket.ackReceived = True
 
                 # send real ACK if you are the destination and you did not yet send the ACK
-                if p.wantAck and p.destId == self.nodeid and not any(pA.requestId == p.seq for pA in self.packets):
+                if p.wantAck and p.destId == self.nodeid and not self.packets.has_request(p.seq):
                     self.verboseprint(round(self.env.now, 3), 'Node', self.nodeid, 'sends a flooding ACK.')
                     self.messageSeq["val"] += 1
                     messageSeq = self.messageSeq["val"]
                     self.messages.append(MeshMessage(self.nodeid, p.origTxNodeId, self.env.now, messageSeq))
-                    pAck = MeshPacket(self.conf, self.nodes, self.nodeid, p.origTxNodeId, self.nodeid, self.conf.ACKLENGTH, messageSeq, self.env.now, False, True, p.seq, self.env.now, self.verboseprint)
+                    pAck = MeshPacket(self.conf, self.packets, self.nodeid, p.origTxNodeId, self.nodeid, self.conf.ACKLENGTH, messageSeq, self.env.now, False, True, p.seq, self.env.now)
                     self.packets.append(pAck)
                     self.env.process(self.transmit(pAck))
                 # Rebroadcasting Logic for received message. This is a broadcast or a DM not meant for us.
@@ -338,7 +401,7 @@ class MeshNode:
                     if self.conf.SELECTED_ROUTER_TYPE == self.conf.ROUTER_TYPE.MANAGED_FLOOD:
                         if not self.isClientMute:
                             self.verboseprint(round(self.env.now, 3), 'Node', self.nodeid, 'rebroadcasts received packet', p.seq)
-                            pNew = MeshPacket(self.conf, self.nodes, p.origTxNodeId, p.destId, self.nodeid, p.packetLen, p.seq, p.genTime, p.wantAck, False, None, self.env.now, self.verboseprint)
+                            pNew = MeshPacket(self.conf, self.packets, p.origTxNodeId, p.destId, self.nodeid, p.packetLen, p.seq, p.genTime, p.wantAck, False, None, self.env.now)
                             pNew.hopLimit = p.hopLimit - 1
                             self.packets.append(pNew)
                             self.env.process(self.transmit(pNew))
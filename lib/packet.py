@@ -1,13 +1,25 @@
-from lib.common import calc_dist
-from lib.phy import airtime, estimate_path_loss
+import collections
+import heapq
+import itertools
+
+import numpy as np
+
+from lib.phy import modem_profile
 
 NODENUM_BROADCAST = 0xFFFFFFFF
 
 
 class MeshPacket:
-	def __init__(self, conf, nodes, origTxNodeId, destId, txNodeId, plen, seq, genTime, wantAck, isAck, requestId, now, verboseprint):
-		self.conf = conf
-		self.verboseprint = verboseprint
+	# many packets are alive at once and created all the time, so no per-instance __dict__
+	# Instances are not pooled: generate_message keeps its packet across retransmission
+	# timeouts, long after it retired, and the allocation is a negligible part of a run.
+	# The per-receiver state is what is worth recycling, through the slab rows.
+	__slots__ = ('origTxNodeId', 'destId', 'txNodeId', 'wantAck', 'isAck', 'seq', 'requestId', 'genTime', 'now', 'txpow',
+				 'sf', 'cr', 'bw', 'freq', 'tx_node', 'slot', 'rssiAtN', 'sensedByN', 'detectedByN', 'collidedAtN', 'receivedAtN',
+				 'onAirToN', 'neighbors', 'cadNeighbors', 'packetLen', 'timeOnAir', 'startTime', 'endTime', 'retransmissions',
+				 'ackReceived', 'hopLimit')
+
+	def __init__(self, conf, packets, origTxNodeId, destId, txNodeId, plen, seq, genTime, wantAck, isAck, requestId, now):
 		self.origTxNodeId = origTxNodeId
 		self.destId = destId
 		self.txNodeId = txNodeId
@@ -17,48 +29,423 @@ class MeshPacket:
 		self.requestId = requestId
 		self.genTime = genTime
 		self.now = now
-		self.txpow = self.conf.PTX
-		self.LplAtN = [0 for _ in range(self.conf.NR_NODES)]
-		self.rssiAtN = [0 for _ in range(self.conf.NR_NODES)]
-		self.sensedByN = [False for _ in range(self.conf.NR_NODES)]
-		self.detectedByN = [False for _ in range(self.conf.NR_NODES)]
-		self.collidedAtN = [False for _ in range(self.conf.NR_NODES)]
-		self.receivedAtN = [False for _ in range(self.conf.NR_NODES)]
-		self.onAirToN = [True for _ in range(self.conf.NR_NODES)]
+		self.txpow = conf.PTX
 
 		# configuration values
-		self.sf = self.conf.SFMODEM[self.conf.MODEM]
-		self.cr = self.conf.CRMODEM[self.conf.MODEM]
-		self.bw = self.conf.BWMODEM[self.conf.MODEM]
-		self.freq = self.conf.FREQ
-		self.tx_node = next(n for n in nodes if n.nodeid == self.txNodeId)
-		for rx_node in nodes:
-			if rx_node.nodeid == self.txNodeId:
-				continue
-			dist_3d = calc_dist(self.tx_node.x, rx_node.x, self.tx_node.y, rx_node.y, self.tx_node.z, rx_node.z)
-			offset = self.conf.LINK_OFFSET[(self.txNodeId, rx_node.nodeid)]
-			self.LplAtN[rx_node.nodeid] = estimate_path_loss(self.conf, dist_3d, self.freq, self.tx_node.z, rx_node.z) + offset
-			self.rssiAtN[rx_node.nodeid] = self.txpow + self.tx_node.antennaGain - self.LplAtN[rx_node.nodeid]
-			if self.rssiAtN[rx_node.nodeid] >= self.conf.SENSMODEM[self.conf.MODEM]:
-				self.sensedByN[rx_node.nodeid] = True
-			if self.rssiAtN[rx_node.nodeid] >= self.conf.CADMODEM[self.conf.MODEM]:
-				self.detectedByN[rx_node.nodeid] = True
+		profile = modem_profile(conf)
+		self.sf = profile.sf
+		self.cr = profile.cr
+		self.bw = profile.bw
+		self.freq = conf.FREQ
+		links = packets.links
+		self.tx_node = links.nodes[self.txNodeId]
+		if conf.SPARSE_RECEIVERS:
+			self.slot = None
+			self.init_sparse(links)
+		else:
+			# per-receiver state lives in a row of the typed arrays of the packet store
+			self.slot = packets.allocate()
+			slab, row = self.slot
+			self.rssiAtN = slab.rssi[row]
+			self.sensedByN = slab.sensed[row]
+			self.detectedByN = slab.detected[row]
+			self.collidedAtN = slab.collided[row]
+			self.receivedAtN = slab.received[row]
+			self.onAirToN = slab.onAir[row]
+			# the link budget of the transmitter is shared, so copy its current row
+			_, self.rssiAtN[:], self.sensedByN[:], self.detectedByN[:] = links.row(self.txNodeId)
+			self.collidedAtN[:] = False
+			self.receivedAtN[:] = False
+			self.onAirToN[:] = True
+		# only these nodes can sense the packet, so only they need reception events
+		self.neighbors = links.neighbors(self.txNodeId)
+		# nodes whose channel activity detection (CAD) notices the packet
+		self.cadNeighbors = links.cad_neighbors(self.txNodeId)
 
 		self.packetLen = plen
-		self.timeOnAir = airtime(self.conf, self.sf, self.cr, self.packetLen, self.bw)
+		self.timeOnAir = profile.airtime(self.packetLen)
 		self.startTime = 0
 		self.endTime = 0
 
 		# Routing
-		self.retransmissions = self.conf.maxRetransmission
+		self.retransmissions = conf.maxRetransmission
 		self.ackReceived = False
 		self.hopLimit = self.tx_node.hopLimit
 
+	def init_sparse(self, links):
+		# Only nodes that detect the packet with CAD get state. The sensitivity is above
+		# the CAD threshold, so this includes every node that can sense it.
+		_, rssi, sensed, _ = links.row(self.txNodeId)
+		index = links.cad_neighbors(self.txNodeId)
+		size = len(links.nodes)
+		self.rssiAtN = SparseVector(index, rssi[index].astype(np.float32), 0, size)
+		self.sensedByN = SparseVector(index, sensed[index], False, size)
+		self.detectedByN = SparseVector(index, np.ones(len(index), dtype=bool), False, size)
+		self.collidedAtN = SparseVector(index, np.zeros(len(index), dtype=bool), False, size)
+		self.receivedAtN = SparseVector(index, np.zeros(len(index), dtype=bool), False, size)
+		self.onAirToN = SparseVector(index, np.ones(len(index), dtype=bool), True, size)
+
+	@property
+	def LplAtN(self):
+		# not stored, follows from the RSSI
+		if isinstance(self.rssiAtN, SparseVector):
+			rssi = self.rssiAtN
+			return SparseVector(rssi.index, self.txpow + self.tx_node.antennaGain - rssi.values, 0, rssi.size)
+		LplAtN = self.txpow + self.tx_node.antennaGain - self.rssiAtN
+		LplAtN[self.txNodeId] = 0
+		return LplAtN
+
+
+class SparseVector:
+	"""
+	Per-receiver values of a packet that are only stored for the nodes in index
+	(sorted), every other node reads as default. Indexing, len() and iteration
+	behave like those of a dense vector of length size.
+	"""
+	__slots__ = ('index', 'values', 'default', 'size')
+
+	def __init__(self, index, values, default, size):
+		self.index = index
+		self.values = values
+		self.default = default
+		self.size = size
+
+	def position(self, nodeid):
+		i = int(self.index.searchsorted(nodeid))
+		if i < len(self.index) and self.index[i] == nodeid:
+			return i
+		return None
+
+	def __getitem__(self, nodeid):
+		i = self.position(nodeid)
+		if i is None:
+			return self.default
+		return self.values[i]
+
+	def __setitem__(self, nodeid, value):
+		i = self.position(nodeid)
+		if i is not None:
+			self.values[i] = value
+		elif value != self.default:
+			raise IndexError(f'Node {nodeid} has no state for this packet')
+
+	def __len__(self):
+		return self.size
+
+	def __array__(self, dtype=None, copy=None):
+		dense = np.full(self.size, self.default, dtype=self.values.dtype)
+		dense[self.index] = self.values
+		return dense if dtype is None else dense.astype(dtype)
+
+	def __iter__(self):
+		return iter(np.asarray(self))
+
+	def count_nonzero(self):
+		count = int(np.count_nonzero(self.values))
+		if self.default:
+			count += self.size - len(self.index)
+		return count
+
+
+def count_receivers(vector):
+	""" Number of nodes for which a dense or sparse per-receiver vector is set. """
+	if isinstance(vector, SparseVector):
+		return vector.count_nonzero()
+	return int(np.count_nonzero(vector))
+
+
+class ReceiverSlab:
+	"""
+	Per-receiver state of a block of packets in typed arrays: float32 RSSI and one
+	byte per flag, instead of seven Python lists of length NR_NODES per packet.
+	Each packet uses one row, exposed as NumPy views under the usual attribute names.
+	"""
+	def __init__(self, nrRows, nrNodes):
+		self.rssi = np.zeros((nrRows, nrNodes), dtype=np.float32)
+		self.sensed = np.zeros((nrRows, nrNodes), dtype=bool)
+		self.detected = np.zeros((nrRows, nrNodes), dtype=bool)
+		self.collided = np.zeros((nrRows, nrNodes), dtype=bool)
+		self.received = np.zeros((nrRows, nrNodes), dtype=bool)
+		self.onAir = np.zeros((nrRows, nrNodes), dtype=bool)
+
+
+def fact_horizon(conf):
+	"""
+	How long the facts about a sequence number are kept once it is off the air: as
+	long as the nodes remember sequence numbers, but at least the 10 minutes of the
+	firmware, so that slow floods and retransmissions still find them.
+	"""
+	return max(conf.PACKET_HISTORY_EXPIRY or 0, 10 * conf.ONE_MIN_INTERVAL)
+
+
+class PacketRegistry:
+	"""
+	All packets of a simulation in creation order, indexed by (origTxNodeId, seq),
+	(txNodeId, seq) and requestId, so that the routing logic can find related
+	packets without scanning every packet that was ever created.
+	Packets are keyed by their id(), which makes removal O(1).
+	It also owns the slabs with the per-receiver state of the packets. Slabs are
+	never resized, so the row views handed out to packets stay valid, and rows of
+	removed packets are reused.
+	Unless retain is set, a packet retires once it is off the air: it is folded into
+	the metrics and dropped, and only the few facts the routing logic still asks
+	about are kept per sequence number (a seq belongs to one message, so it implies
+	the origTxNodeId). The routing only asks about a seq while copies of it or ACKs
+	for it are queued or on the air, so the facts of a seq are forgotten once none
+	are left and the last one went off the air expiry ms ago (see fact_horizon).
+	After every FORGET_BATCH forgotten seqs, the metrics drop what they keep of the
+	seqs below the oldest one still known.
+	"""
+	FORGET_BATCH = 1 << 15
+
+	def __init__(self, links, metrics=None, retain=True, expiry=None, slabRows=512):
+		self.links = links
+		self.metrics = metrics
+		self.retain = retain
+		self.expiry = expiry
+		self.slabRows = slabRows
+		self.slabs = []
+		self.freeRows = []
+		self.packets = {}
+		self.byOrig = {}
+		self.byTx = {}
+		self.byRequest = {}
+		self.finished = False
+		# transmitted packets by endTime, to retire them
+		self.onAir = []
+		self.counter = itertools.count()
+		# facts of retired packets
+		self.retiredTimes = collections.OrderedDict()  # seq -> when its last packet retired, oldest first
+		self.retiredOrig = {}  # seq -> origTxNodeId
+		self.retiredTx = {}  # seq -> set of txNodeIds
+		self.retiredRequests = set()
+		self.retiredRetransmissions = {}  # seq -> minimum retransmissions left
+		self.ackedSeqs = set()
+		self.forgotten = 0
+
+	def __len__(self):
+		return len(self.packets)
+
+	def __iter__(self):
+		return iter(list(self.packets.values()))
+
+	def append(self, packet):
+		self.retire(packet.now)
+		self.packets[id(packet)] = packet
+		self.byOrig.setdefault((packet.origTxNodeId, packet.seq), {})[id(packet)] = packet
+		self.byTx.setdefault((packet.txNodeId, packet.seq), {})[id(packet)] = packet
+		if packet.requestId is not None:
+			self.byRequest.setdefault(packet.requestId, {})[id(packet)] = packet
+
+	def remove(self, packet):
+		del self.packets[id(packet)]
+		if packet.slot is not None:
+			self.freeRows.append(packet.slot)
+		self.discard(self.byOrig, (packet.origTxNodeId, packet.seq), packet)
+		self.discard(self.byTx, (packet.txNodeId, packet.seq), packet)
+		if packet.requestId is not None:
+			self.discard(self.byRequest, packet.requestId, packet)
+
+	def allocate(self):
+		""" Reserve a (slab, row) for the per-receiver state of a new packet. """
+		if not self.freeRows:
+			slab = ReceiverSlab(self.slabRows, len(self.links.nodes))
+			self.slabs.append(slab)
+			self.freeRows.extend((slab, row) for row in reversed(range(self.slabRows)))
+		return self.freeRows.pop()
+
+	@staticmethod
+	def discard(index, key, packet):
+		del index[key][id(packet)]
+		if not index[key]:
+			del index[key]
+
+	def transmitted(self, packet):
+		""" Called when packet goes on the air, with its startTime and endTime set. """
+		self.retire(packet.startTime)
+		if not self.retain:
+			heapq.heappush(self.onAir, (packet.endTime, next(self.counter), packet))
+
+	def retire(self, now):
+		# Packets that ended before now get no more events: all receptions end at endTime.
+		while self.onAir and self.onAir[0][0] < now:
+			_, _, packet = heapq.heappop(self.onAir)
+			if self.metrics is not None:
+				self.metrics.add_packet(packet)
+			self.retiredOrig[packet.seq] = packet.origTxNodeId
+			self.retiredTx.setdefault(packet.seq, set()).add(packet.txNodeId)
+			self.touch(packet.seq, packet.endTime)
+			if packet.requestId is not None:
+				self.retiredRequests.add(packet.requestId)
+				self.touch(packet.requestId, packet.endTime)
+			left = self.retiredRetransmissions.get(packet.seq, packet.retransmissions)
+			self.retiredRetransmissions[packet.seq] = min(left, packet.retransmissions)
+			if packet.ackReceived:
+				self.ackedSeqs.add(packet.seq)
+			self.remove(packet)
+		self.expire(now)
+
+	def touch(self, seq, now):
+		self.retiredTimes[seq] = now
+		self.retiredTimes.move_to_end(seq)
+
+	def expire(self, now):
+		""" Forget the facts of the sequence numbers whose last packet retired at least expiry ms ago. """
+		if self.expiry is None:
+			return
+		while self.retiredTimes:
+			seq, retired = next(iter(self.retiredTimes.items()))
+			if retired + self.expiry > now:
+				break
+			if (self.retiredOrig.get(seq), seq) in self.byOrig or seq in self.byRequest:
+				# a copy still waits in a queue, so the routing will ask again once it is sent
+				self.touch(seq, now)
+				continue
+			del self.retiredTimes[seq]
+			self.retiredOrig.pop(seq, None)
+			self.retiredTx.pop(seq, None)
+			self.retiredRequests.discard(seq)
+			self.retiredRetransmissions.pop(seq, None)
+			self.ackedSeqs.discard(seq)
+			self.forgotten += 1
+		if self.forgotten >= self.FORGET_BATCH and self.metrics is not None:
+			self.forgotten = 0
+			oldest = min(itertools.chain(self.retiredTimes, (packet.seq for packet in self.packets.values())), default=None)
+			if oldest is not None:
+				self.metrics.forget_before(oldest)
+
+	def finish(self):
+		""" Fold the packets that did not retire yet into the metrics, at the end of the simulation. """
+		if self.finished:
+			return
+		self.finished = True
+		if self.metrics is not None:
+			for packet in self.packets.values():
+				self.metrics.add_packet(packet)
+
+	def with_orig(self, origTxNodeId, seq):
+		""" Registered packets carrying message seq generated by origTxNodeId, in creation order. """
+		return list(self.byOrig.get((origTxNodeId, seq), {}).values())
+
+	def with_tx(self, txNodeId, seq):
+		""" Registered packets with sequence number seq (re)transmitted by txNodeId, in creation order. """
+		return list(self.byTx.get((txNodeId, seq), {}).values())
+
+	def with_request(self, requestId):
+		""" Registered ACK packets for message requestId, in creation order. """
+		return list(self.byRequest.get(requestId, {}).values())
+
+	def has_request(self, requestId):
+		""" Whether an ACK for message requestId was ever created. """
+		return requestId in self.byRequest or requestId in self.retiredRequests
+
+	def acknowledge_tx(self, txNodeId, seq):
+		""" Mark the packets with seq sent by txNodeId as acknowledged. Returns whether there were any. """
+		packets = self.with_tx(txNodeId, seq)
+		for packet in packets:
+			packet.ackReceived = True
+		if txNodeId in self.retiredTx.get(seq, ()):
+			self.ackedSeqs.add(seq)
+			return True
+		return len(packets) > 0
+
+	def acknowledge_orig(self, origTxNodeId, seq):
+		""" Mark the packets of message seq generated by origTxNodeId as acknowledged. Returns whether there were any. """
+		packets = self.with_orig(origTxNodeId, seq)
+		for packet in packets:
+			packet.ackReceived = True
+		if self.retiredOrig.get(seq) == origTxNodeId:
+			self.ackedSeqs.add(seq)
+			return True
+		return len(packets) > 0
+
+	def retransmission_state(self, origTxNodeId, seq, maxRetransmissions):
+		"""
+		Minimum number of retransmissions left over all packets of message seq generated
+		by origTxNodeId (at most maxRetransmissions), and whether any of them was acknowledged.
+		"""
+		minRetransmissions = maxRetransmissions
+		ackReceived = False
+		if self.retiredOrig.get(seq) == origTxNodeId:
+			minRetransmissions = min(minRetransmissions, self.retiredRetransmissions[seq])
+			ackReceived = seq in self.ackedSeqs
+		for packet in self.with_orig(origTxNodeId, seq):
+			minRetransmissions = min(minRetransmissions, packet.retransmissions)
+			ackReceived = ackReceived or packet.ackReceived
+		return minRetransmissions, ackReceived
+
 
 class MeshMessage:
+	__slots__ = ('origTxNodeId', 'destId', 'genTime', 'seq', 'endTime')
+
 	def __init__(self, origTxNodeId, destId, genTime, seq):
 		self.origTxNodeId = origTxNodeId
 		self.destId = destId
 		self.genTime = genTime
 		self.seq = seq
 		self.endTime = 0
+
+
+class PacketHistory:
+	"""
+	How often a node heard each recent sequence number, like the PacketHistory of the
+	firmware. Entries are kept in a ring buffer in the order they were added, with a
+	dict from seq to [times received, time added] as index. With capacity, adding to
+	a full history forgets the oldest entry; with expiry, entries are forgotten expiry
+	ms after they were added. Without either, nothing is ever forgotten.
+	"""
+	def __init__(self, capacity=None, expiry=None):
+		self.capacity = capacity
+		self.expiry = expiry
+		self.ring = collections.deque()  # seqs, oldest first
+		self.index = {}  # seq -> [times received, time added]
+
+	def __len__(self):
+		return len(self.index)
+
+	def expire(self, now):
+		if self.expiry is None:
+			return
+		while self.ring and self.index[self.ring[0]][1] + self.expiry <= now:
+			del self.index[self.ring.popleft()]
+
+	def get(self, seq, now):
+		""" Times seq was received, or None if it is not (or no longer) in the history. """
+		self.expire(now)
+		entry = self.index.get(seq)
+		return None if entry is None else entry[0]
+
+	def add(self, seq, count, now):
+		if self.capacity is not None and len(self.ring) >= self.capacity:
+			del self.index[self.ring.popleft()]
+		self.ring.append(seq)
+		self.index[seq] = [count, now]
+
+	def increment(self, seq, count):
+		self.index[seq][0] += count
+
+
+class ActivePackets:
+	"""
+	Packets that arrived at a node, kept in a heap ordered by endTime, so packets
+	that are no longer on the air can be evicted cheaply and checks only see the
+	packets that may still overlap.
+	"""
+	def __init__(self):
+		self.heap = []
+		self.counter = itertools.count()  # tie breaker for packets that end at the same time
+
+	def add(self, packet):
+		# packets that ended before this one started cannot overlap with anything to come
+		while self.heap and self.heap[0][0] < packet.startTime:
+			heapq.heappop(self.heap)
+		heapq.heappush(self.heap, (packet.endTime, next(self.counter), packet))
+
+	def overlapping(self, now, includeEnding=False):
+		"""
+		Evict the packets that ended at or before now and return those still on the air.
+		With includeEnding, packets that end exactly at now are kept as well.
+		"""
+		while self.heap and (self.heap[0][0] < now or (self.heap[0][0] == now and not includeEnding)):
+			heapq.heappop(self.heap)
+		return [packet for _, _, packet in self.heap]
@@ -1,7 +1,10 @@
 import math
 import random
 
+import numpy as np
+
 from lib.config import Config
+from lib.trace import COLLIDED
 
 conf = Config()
 
@@ -13,19 +16,66 @@ def verboseprint(*args, **kwargs):
         print(*args, **kwargs)
 
 
-#                           CAD duration   +     airPropagationTime+TxRxTurnaround+MACprocessing
-SLOT_TIME = 8.5 * (2.0 ** conf.SFMODEM[conf.MODEM]) / conf.BWMODEM[conf.MODEM] * 1000 + 0.2 + 0.4 + 7
-
-
-def check_collision(conf, env, packet, rx_nodeId, packetsAtN):
+class ModemProfile:
+    """
+    Everything that follows from the modem of a Config, computed once: the airtime of
+    every payload length up to MAX_PAYLOAD, the CAD slot time, the preamble time after
+    which a packet can no longer be disturbed, the sensitivity and CAD thresholds,
+    and (memoized per antenna gain and heights) the maximum range.
+    Get it with modem_profile(conf) rather than constructing it.
+    """
+    MAX_PAYLOAD = 255
+
+    def __init__(self, conf):
+        self.conf = conf
+        self.modem = conf.MODEM
+        self.sf = conf.SFMODEM[conf.MODEM]
+        self.cr = conf.CRMODEM[conf.MODEM]
+        self.bw = conf.BWMODEM[conf.MODEM]
+        self.airtimes = [airtime(conf, self.sf, self.cr, pl, self.bw) for pl in range(self.MAX_PAYLOAD + 1)]
+        #               CAD duration   +     airPropagationTime+TxRxTurnaround+MACprocessing
+        self.slotTime = 8.5 * (2.0 ** self.sf) / self.bw * 1000 + 0.2 + 0.4 + 7
+        # a packet only collides when more than the first NPREAM - 5 preamble symbols overlap
+        self.preambleLockTime = 2 ** self.sf / (1.0 * self.bw) * (conf.NPREAM - 5)
+        self.sensitivity = conf.SENSMODEM[conf.MODEM]
+        self.cadThreshold = conf.CADMODEM[conf.MODEM]
+        self.maxRanges = {}
+
+    def airtime(self, payloadLength):
+        """ Time on air (ms) of a packet with the given payload length. """
+        if 0 <= payloadLength <= self.MAX_PAYLOAD:
+            return self.airtimes[payloadLength]
+        return airtime(self.conf, self.sf, self.cr, payloadLength, self.bw)
+
+    def max_range(self, gain, txZ=conf.HM, rxZ=conf.HM):
+        """ Distance (m) at which the RSSI of a link with total antenna gain equals the sensitivity. """
+        key = (gain, txZ, rxZ)
+        if key not in self.maxRanges:
+            self.maxRanges[key] = estimate_max_range(gain, self.conf, txZ, rxZ)
+        return self.maxRanges[key]
+
+
+def modem_profile(conf):
+    """ The ModemProfile of conf, built on first use and again when conf.MODEM changed. """
+    profile = conf.modemProfile
+    if profile is None or profile.modem != conf.MODEM:
+        profile = conf.modemProfile = ModemProfile(conf)
+    return profile
+
+
+def check_collision(conf, env, packet, rx_nodeId, packetsAtN, trace=None):
     # Check for collisions at rx_node
     col = 0
     if conf.COLLISION_DUE_TO_INTERFERENCE:
         if random.randrange(10) <= conf.INTERFERENCE_LEVEL * 10:
             packet.collidedAtN[rx_nodeId] = True
+            if trace is not None:
+                trace.record(env.now, COLLIDED, rx_nodeId, packet, packet.rssiAtN[rx_nodeId])
 
-    if packetsAtN[rx_nodeId]:
-        for other in packetsAtN[rx_nodeId]:
+    # packets that ended before now cannot overlap with this one anymore
+    overlapping = packetsAtN[rx_nodeId].overlapping(env.now)
+    if overlapping:
+        for other in overlapping:
             if frequency_collision(packet, other) and sf_collision(packet, other):
                 if timing_collision(conf, env, packet, other):
                     verboseprint(f'Packet nr. {packet.seq} from {packet.txNodeId} and packet nr. {other.seq} from {other.txNodeId} will collide!')
@@ -33,6 +83,8 @@ def check_collision(conf, env, packet, rx_nodeId, packetsAtN):
                     # mark all the collided packets
                     for p in c:
                         p.collidedAtN[rx_nodeId] = True
+                        if trace is not None:
+                            trace.record(env.now, COLLIDED, rx_nodeId, p, p.rssiAtN[rx_nodeId])
                         if p == packet:
                             col = 1
                 else:
@@ -72,8 +124,7 @@ def timing_collision(conf, env, p1, p2):
     """ assuming p1 is the freshly arrived packet, check if the packet collides 
         or not (when only the first n - 5 preamble symbols overlap)
     """
-    Tpreamb = 2 ** p1.sf / (1.0 * p1.bw) * (conf.NPREAM - 5)
-    p1_cs = env.now + Tpreamb
+    p1_cs = env.now + modem_profile(conf).preambleLockTime
     if p1_cs < p2.endTime:  # p1 collided with p2 and lost
         return True
     return False
@@ -82,11 +133,12 @@ def timing_collision(conf, env, p1, p2):
 def is_channel_active(node, env):
     if random.randrange(10) <= node.conf.INTERFERENCE_LEVEL * 10:
         return True
-    for p in node.packets:
-        if p.detectedByN[node.nodeid]:
-            # You will miss detecting a packet if it has just started before you could do CAD
-            if p.startTime + SLOT_TIME <= env.now <= p.endTime:
-                return True
+    slotTime = modem_profile(node.conf).slotTime
+    # only packets this node can detect that did not end yet
+    for p in node.channelActivity.overlapping(env.now, includeEnding=True):
+        # You will miss detecting a packet if it has just started before you could do CAD
+        if p.startTime + slotTime <= env.now:
+            return True
     return False
 
 
@@ -109,38 +161,39 @@ def airtime(conf, sf, cr, pl, bw):
 
 
 def estimate_path_loss(conf, dist, freq, txZ=conf.HM, rxZ=conf.HM):
+    # Works element-wise when dist, txZ and rxZ are NumPy arrays
     # With randomized movements we may end up on top of another node which is problematic for log(dist)
-    dist = max(dist, .001)
+    dist = np.maximum(dist, .001)
 
     # Log-Distance model
     if conf.MODEL == 0:
-        Lpl = conf.LPLD0 + 10 * conf.GAMMA * math.log10(dist / conf.D0)
+        Lpl = conf.LPLD0 + 10 * conf.GAMMA * np.log10(dist / conf.D0)
 
     # Okumura-Hata model
     elif 1 <= conf.MODEL <= 4:
         # small and medium-size cities
         if conf.MODEL == 1:
-            ahm = (1.1 * (math.log10(freq) - 6.0) - 0.7) * rxZ - (1.56 * (math.log10(freq) - 6.0) - 0.8)
+            ahm = (1.1 * (np.log10(freq) - 6.0) - 0.7) * rxZ - (1.56 * (np.log10(freq) - 6.0) - 0.8)
             C = 0
         # metropolitan areas
         elif conf.MODEL == 2:
             if freq <= 200000000:
-                ahm = 8.29 * ((math.log10(1.54 * rxZ)) ** 2) - 1.1
+                ahm = 8.29 * ((np.log10(1.54 * rxZ)) ** 2) - 1.1
             elif freq >= 400000000:
-                ahm = 3.2 * ((math.log10(11.75 * rxZ)) ** 2) - 4.97
+                ahm = 3.2 * ((np.log10(11.75 * rxZ)) ** 2) - 4.97
             C = 0
         # suburban environments
         elif conf.MODEL == 3:
-            ahm = (1.1 * (math.log10(freq) - 6.0) - 0.7) * rxZ - (1.56 * (math.log10(freq) - 6.0) - 0.8)
-            C = -2 * ((math.log10(freq) - math.log10(28000000)) ** 2) - 5.4
+            ahm = (1.1 * (np.log10(freq) - 6.0) - 0.7) * rxZ - (1.56 * (np.log10(freq) - 6.0) - 0.8)
+            C = -2 * ((np.log10(freq) - np.log10(28000000)) ** 2) - 5.4
         # rural area
         elif conf.MODEL == 4:
-            ahm = (1.1 * (math.log10(freq) - 6.0) - 0.7) * rxZ - (1.56 * (math.log10(freq) - 6.0) - 0.8)
-            C = -4.78 * ((math.log10(freq) - 6.0) ** 2) + 18.33 * (math.log10(freq) - 6.0) - 40.98
+            ahm = (1.1 * (np.log10(freq) - 6.0) - 0.7) * rxZ - (1.56 * (np.log10(freq) - 6.0) - 0.8)
+            C = -4.78 * ((np.log10(freq) - 6.0) ** 2) + 18.33 * (np.log10(freq) - 6.0) - 40.98
 
-        A = 69.55 + 26.16 * (math.log10(freq) - 6.0) - 13.82 * math.log10(txZ) - ahm
-        B = 44.9 - 6.55 * math.log10(txZ)
-        Lpl = A + B * (math.log10(dist) - 3.0) + C
+        A = 69.55 + 26.16 * (np.log10(freq) - 6.0) - 13.82 * np.log10(txZ) - ahm
+        B = 44.9 - 6.55 * np.log10(txZ)
+        Lpl = A + B * (np.log10(dist) - 3.0) + C
 
     # 3GPP model
     elif 5 <= conf.MODEL < 7:
@@ -151,17 +204,13 @@ def estimate_path_loss(conf, dist, freq, txZ=conf.HM, rxZ=conf.HM):
         elif conf.MODEL == 6:
             C = 3  # dB
 
-        Lpl = (44.9 - 6.55 * math.log10(txZ)) * (math.log10(dist) - 3.0) \
-            + 45.5 + (35.46 - 1.1 * rxZ) * (math.log10(freq) - 6.0) \
-            - 13.82 * math.log10(rxZ) + 0.7 * rxZ + C
+        Lpl = (44.9 - 6.55 * np.log10(txZ)) * (np.log10(dist) - 3.0) \
+            + 45.5 + (35.46 - 1.1 * rxZ) * (np.log10(freq) - 6.0) \
+            - 13.82 * np.log10(rxZ) + 0.7 * rxZ + C
 
     return Lpl
 
 
-def zero_link_budget(dist):
-    return conf.PTX + 2 * conf.GL - estimate_path_loss(conf, dist, conf.FREQ) - conf.SENSMODEM[conf.MODEM]
-
-
 def rootFinder(func, x0, args=(), tol=1, maxiter=100):
   """Newton-Raphson root finder."""
   x = x0
@@ -178,10 +227,8 @@ def rootFinder(func, x0, args=(), tol=1, maxiter=100):
   print("Warning: could not estimate max. range")
   return x
 
-def zero_link_budget_with_gain(dist, gain):
-    return conf.PTX + gain - estimate_path_loss(conf, dist, conf.FREQ) - conf.SENSMODEM[conf.MODEM]
-
-def estimate_max_range(gain):
-    return rootFinder(zero_link_budget_with_gain, 1500, args=(gain,))
+def zero_link_budget_with_gain(dist, gain, conf=conf, txZ=conf.HM, rxZ=conf.HM):
+    return conf.PTX + gain - estimate_path_loss(conf, dist, conf.FREQ, txZ, rxZ) - conf.SENSMODEM[conf.MODEM]
 
-MAXRANGE = rootFinder(zero_link_budget, 1500)
+def estimate_max_range(gain, conf=conf, txZ=conf.HM, rxZ=conf.HM):
+    return rootFinder(zero_link_budget_with_gain, 1500, args=(gain, conf, txZ, rxZ))
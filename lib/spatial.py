@@ -0,0 +1,47 @@
+import math
+
+
+class SpatialGrid:
+    """
+    Uniform grid over node positions for radius queries. With the cell size set to
+    the (maximum) query radius, a query only looks at the 3x3 cells around a point
+    instead of at every node.
+    """
+    def __init__(self, cellSize):
+        self.cellSize = cellSize
+        self.cells = {}  # (column, row) -> {key: (x, y)}
+        self.positions = {}  # key -> (x, y)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def cell(self, x, y):
+        return math.floor(x / self.cellSize), math.floor(y / self.cellSize)
+
+    def insert(self, key, x, y):
+        if key in self.positions:
+            self.remove(key)
+        self.positions[key] = (x, y)
+        self.cells.setdefault(self.cell(x, y), {})[key] = (x, y)
+
+    def remove(self, key):
+        x, y = self.positions.pop(key)
+        cell = self.cell(x, y)
+        del self.cells[cell][key]
+        if not self.cells[cell]:
+            del self.cells[cell]
+
+    def move(self, key, x, y):
+        self.insert(key, x, y)
+
+    def query(self, x, y, radius):
+        """ Keys of the points within radius (2D) of (x, y). """
+        span = math.ceil(radius / self.cellSize)
+        column, row = self.cell(x, y)
+        found = []
+        for i in range(column - span, column + span + 1):
+            for j in range(row - span, row + span + 1):
+                for key, (px, py) in self.cells.get((i, j), {}).items():
+                    if (px - x) ** 2 + (py - y) ** 2 <= radius ** 2:
+                        found.append(key)
+        return found
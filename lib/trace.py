@@ -0,0 +1,141 @@
+"""
+Binary event trace of a simulation run.
+
+A trace file is a 64-byte header followed by fixed-width records, appended in
+chunks while the simulation runs, so records are in simulated time order.
+
+Header: the magic bytes b'MTTRACE\\0', then the format version and the record
+size as little-endian uint32, padded with zeros to 64 bytes.
+
+Records (little-endian, packed, 36 bytes, see TRACE_DTYPE):
+    time          float64  simulated time of the event (ms)
+    seq           int64    sequence number of the packet
+    node          int32    node at which the event happened
+    txNodeId      int32    transmitter of the packet
+    origTxNodeId  int32    node that generated the message
+    rssi          float32  RSSI of the packet at node (dBm), NaN for own packets
+    hopLimit      int16    hop limit of the packet
+    event         uint8    one of the event codes below
+    isAck         uint8    1 if the packet is a (real) ACK
+
+The file can be read with TraceReader, or with any tool that can memory-map a
+packed array, e.g. np.memmap(path, dtype=TRACE_DTYPE, mode='r', offset=HEADER_SIZE).
+"""
+import math
+import os
+import struct
+
+import numpy as np
+
+MAGIC = b'MTTRACE\0'
+VERSION = 1
+HEADER_SIZE = 64
+
+TRACE_DTYPE = np.dtype([
+    ('time', '<f8'),
+    ('seq', '<i8'),
+    ('node', '<i4'),
+    ('txNodeId', '<i4'),
+    ('origTxNodeId', '<i4'),
+    ('rssi', '<f4'),
+    ('hopLimit', '<i2'),
+    ('event', 'u1'),
+    ('isAck', 'u1'),
+])
+
+# event codes
+GENERATED = 1  # node created a new message
+RETRANSMITTED = 2  # node retransmits its own message, no ACK received
+TX_STARTED = 3  # node starts transmitting the packet
+TX_CANCELLED = 4  # node drops the packet from its queue, it was already ACKed or rebroadcast by others
+RX_STARTED = 5  # node starts receiving the packet
+RX_MISSED = 6  # node could not receive the packet because it was transmitting
+RX_DECODED = 7  # node received the packet
+RX_FAILED = 8  # node could not decode the packet because it collided
+COLLIDED = 9  # the packet is marked as collided at node
+
+EVENT_NAMES = {
+    GENERATED: 'generated',
+    RETRANSMITTED: 'retransmitted',
+    TX_STARTED: 'tx started',
+    TX_CANCELLED: 'tx cancelled',
+    RX_STARTED: 'rx started',
+    RX_MISSED: 'rx missed',
+    RX_DECODED: 'rx decoded',
+    RX_FAILED: 'rx failed',
+    COLLIDED: 'collided',
+}
+
+
+class TraceRecorder:
+    """ Appends trace records to a file, buffered in chunks of chunkRecords records. """
+    def __init__(self, path, chunkRecords=65536):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(path, 'wb')
+        self.file.write(struct.pack('<8sII', MAGIC, VERSION, TRACE_DTYPE.itemsize).ljust(HEADER_SIZE, b'\0'))
+        self.buffer = np.zeros(chunkRecords, dtype=TRACE_DTYPE)
+        self.filled = 0
+        self.count = 0
+
+    def record(self, time, event, node, packet, rssi=math.nan):
+        self.buffer[self.filled] = (time, packet.seq, node, packet.txNodeId, packet.origTxNodeId, rssi, packet.hopLimit, event, packet.isAck)
+        self.filled += 1
+        self.count += 1
+        if self.filled == len(self.buffer):
+            self.flush()
+
+    def flush(self):
+        self.file.write(self.buffer[:self.filled].tobytes())
+        self.file.flush()
+        self.filled = 0
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+
+class TraceReader:
+    """
+    Memory-mapped view of a trace file: opening is instant, and selections only
+    touch the pages they need. Time ranges use a binary search on the (sorted)
+    time column, node, seq and event filters a mask over that range.
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            magic, version, recordSize = struct.unpack('<8sII', file.read(16))
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a trace file')
+        if version != VERSION or recordSize != TRACE_DTYPE.itemsize:
+            raise ValueError(f'{path} has trace format version {version} with {recordSize}-byte records, expected version {VERSION}')
+        count = (os.path.getsize(path) - HEADER_SIZE) // TRACE_DTYPE.itemsize
+        if count > 0:
+            self.records = np.memmap(path, dtype=TRACE_DTYPE, mode='r', offset=HEADER_SIZE, shape=(count,))
+        else:
+            self.records = np.zeros(0, dtype=TRACE_DTYPE)
+
+    def __len__(self):
+        return len(self.records)
+
+    def between(self, start=None, end=None):
+        """ Records with start <= time < end, as a view. """
+        times = self.records['time']
+        first = 0 if start is None else int(np.searchsorted(times, start, side='left'))
+        last = len(times) if end is None else int(np.searchsorted(times, end, side='left'))
+        return self.records[first:last]
+
+    def select(self, start=None, end=None, node=None, seq=None, event=None, txNodeId=None):
+        """ Records in the time range that match all given filters; each filter may be a value or a list of values. """
+        records = self.between(start, end)
+        mask = None
+        for field, wanted in (('node', node), ('seq', seq), ('event', event), ('txNodeId', txNodeId)):
+            if wanted is None:
+                continue
+            match = np.isin(records[field], wanted)
+            mask = match if mask is None else mask & match
+        if mask is None:
+            return records
+        return records[mask]
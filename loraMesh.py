@@ -4,13 +4,17 @@ import sys
 import random
 
 import yaml
-import simpy
-import numpy as np
 
 from lib.common import Graph, plot_schedule, gen_scenario, run_graph_updates, setup_asymmetric_links
 from lib.config import Config
-from lib.discrete_event import BroadcastPipe
+from lib.discrete_event import BroadcastPipe, run_simulation_time
+from lib.kernel import ENGINES, make_environment
+from lib.link import LinkBudget
+from lib.metrics import MetricsCollector, PacketLog
+from lib.mobility import MobilityEngine
 from lib.node import MeshNode
+from lib.packet import ActivePackets, PacketRegistry, fact_horizon
+from lib.trace import TraceRecorder
 
 VERBOSE = True
 conf = Config()
@@ -22,10 +26,22 @@ def verboseprint(*args, **kwargs):
 		print(*args, **kwargs)
 
 
+def parse_engine(conf, args):
+	# takes --engine simpy|fast out of the arguments
+	if "--engine" not in args:
+		return args
+	i = args.index("--engine")
+	if i + 1 >= len(args) or args[i + 1] not in ENGINES:
+		print(f"The engine must be one of: {', '.join(ENGINES)}")
+		exit(1)
+	conf.ENGINE = args[i + 1]
+	return args[:i] + args[i + 2:]
+
+
 def parse_params(conf, args):
 	# TODO: refactor with argparse
 	if len(args) > 3:
-		print("Usage: ./loraMesh [nr_nodes] [--from-file [file_name]]")
+		print("Usage: ./loraMesh [nr_nodes] [--from-file [file_name]] [--engine simpy|fast]")
 		print("Do not specify the number of nodes when reading from a file.")
 		exit(1)
 	else:
@@ -67,20 +83,24 @@ def parse_params(conf, args):
 	print("Simulation time (s):", conf.SIMTIME/1000)
 	print("Period (s):", conf.PERIOD/1000)
 	print("Interference level:", conf.INTERFERENCE_LEVEL)
+	print("Engine:", conf.ENGINE)
 	return config
 
 
-nodeConfig = parse_params(conf, sys.argv)
+nodeConfig = parse_params(conf, parse_engine(conf, sys.argv))
 conf.update_router_dependencies()
-env = simpy.Environment()
-bc_pipe = BroadcastPipe(env)
+env = make_environment(conf.ENGINE)
+bc_pipe = BroadcastPipe(env, neighborDelivery=conf.NEIGHBOR_DELIVERY)
 
 # simulation variables
 nodes = []
+links = LinkBudget(conf, nodes)
 messages = []
-packets = []
-delays = []
-packetsAtN = [[] for _ in range(conf.NR_NODES)]
+packetLog = PacketLog(conf.NR_NODES) if conf.PACKET_LOG or conf.PLOT else None
+metrics = MetricsCollector(packetLog)
+packets = PacketRegistry(links, metrics, retain=conf.RETAIN_PACKETS, expiry=fact_horizon(conf))
+packetsAtN = [ActivePackets() for _ in range(conf.NR_NODES)]
+trace = TraceRecorder(conf.TRACE_FILE) if conf.TRACE_FILE else None
 messageSeq = {"val": 0}
 totalPairs = 0
 symmetricLinks = 0
@@ -89,52 +109,57 @@ noLinks = 0
 
 graph = Graph(conf)
 for i in range(conf.NR_NODES):
-	node = MeshNode(conf, nodes, env, bc_pipe, i, conf.PERIOD, messages, packetsAtN, packets, delays, nodeConfig[i], messageSeq, verboseprint)
+	node = MeshNode(conf, nodes, links, env, bc_pipe, i, conf.PERIOD, messages, packetsAtN, packets, metrics, nodeConfig[i], messageSeq, verboseprint, trace)
 	nodes.append(node)
 	graph.add_node(node)
 
 totalPairs, symmetricLinks, asymmetricLinks, noLinks = setup_asymmetric_links(conf, nodes)
 
 if conf.MOVEMENT_ENABLED:
+	if conf.MOBILITY_ENGINE:
+		MobilityEngine(conf, env, nodes, links)
 	env.process(run_graph_updates(env, graph, nodes, conf.ONE_MIN_INTERVAL))
 
 conf.update_router_dependencies()
 
 # start simulation
 print("\n====== START OF SIMULATION ======")
-env.run(until=conf.SIMTIME)
+run_simulation_time(conf, env)
+packets.finish()
+if trace is not None:
+	trace.close()
+	print('Event trace written to', conf.TRACE_FILE)
 
 # compute statistics
 print("\n====== END OF SIMULATION ======")
 print("*******************************")
 print(f"\nRouter Type: {conf.SELECTED_ROUTER_TYPE}")
 print('Number of messages created:', messageSeq["val"])
-sent = len(packets)
+summary = metrics.summary(nodes, messageSeq["val"])
+sent = summary['packets']
 if conf.DMs:
 	potentialReceivers = sent
 else:
 	potentialReceivers = sent*(conf.NR_NODES-1)
 print('Number of packets sent:', sent, 'to', potentialReceivers, 'potential receivers')
-nrCollisions = sum([1 for p in packets for n in nodes if p.collidedAtN[n.nodeid] is True])
+nrCollisions = summary['collisions']
 print("Number of collisions:", nrCollisions)
-nrSensed = sum([1 for p in packets for n in nodes if p.sensedByN[n.nodeid] is True])
+nrSensed = summary['sensed']
 print("Number of packets sensed:", nrSensed)
-nrReceived = sum([1 for p in packets for n in nodes if p.receivedAtN[n.nodeid] is True])
+nrReceived = summary['received']
 print("Number of packets received:", nrReceived)
-meanDelay = np.nanmean(delays)
+meanDelay = summary['meanDelay']
 print('Delay average (ms):', round(meanDelay, 2))
 txAirUtilization = sum([n.txAirUtilization for n in nodes])/conf.NR_NODES/conf.SIMTIME*100
 print('Average Tx air utilization:', round(txAirUtilization, 2), '%')
 if nrSensed != 0:
-	collisionRate = float((nrCollisions)/nrSensed)
-	print("Percentage of packets that collided:", round(collisionRate*100, 2))
+	print("Percentage of packets that collided:", round(summary['collisionRate']*100, 2))
 else:
 	print("No packets sensed.")
-nodeReach = sum([n.usefulPackets for n in nodes])/(messageSeq["val"]*(conf.NR_NODES-1))
-print("Average percentage of nodes reached:", round(nodeReach*100, 2))
+print("Average percentage of nodes reached:", round(summary['reachability']*100, 2))
 if nrReceived != 0:
-	usefulness = sum([n.usefulPackets for n in nodes])/nrReceived  # nr of packets that delivered to a packet to a new receiver out of all packets sent
-	print("Percentage of received packets containing new message:", round(usefulness*100, 2))
+	# nr of packets that delivered to a packet to a new receiver out of all packets sent
+	print("Percentage of received packets containing new message:", round(summary['usefulness']*100, 2))
 else:
 	print('No packets received.')
 delayDropped = sum(n.droppedByDelay for n in nodes)
@@ -154,4 +179,4 @@ if conf.MOVEMENT_ENABLED:
 graph.save()
 
 if conf.PLOT:
-	plot_schedule(conf, packets, messages)
+	plot_schedule(conf, packetLog, messages)
@@ -1,11 +1,14 @@
 #!/usr/bin/env python3
+import os
+
 import matplotlib
 import numpy as np
 import pandas as pd
 from matplotlib import pyplot as plt
 
 try:
-    matplotlib.use("TkAgg")
+    # a backend set in MPLBACKEND (e.g. Agg to run without a display) takes precedence
+    matplotlib.use(os.environ.get("MPLBACKEND", "TkAgg"))
 except ImportError:
     print('Tkinter is needed. Install python3-tk with your package manager.')
 
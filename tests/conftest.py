@@ -0,0 +1,6 @@
+import os
+import sys
+
+# run without a display, and import lib from the repository root
+os.environ.setdefault("MPLBACKEND", "Agg")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,198 @@
+import json
+import os
+import shutil
+
+import pytest
+
+from lib import batch
+from lib.batch import (ResultCache, confidence_halfwidth, job_key, load_sweep, normalize_sweep, parameter_grid, point_jobs, run_jobs, run_sweep,
+                       t_quantile, validate_search)
+from lib.config import Config
+
+
+# two-sided critical values from a table of Student's t-distribution
+T_TABLE = [
+    (0.975, 1, 12.706), (0.995, 1, 63.657),
+    (0.975, 2, 4.303), (0.995, 2, 9.925),
+    (0.95, 3, 2.353), (0.975, 3, 3.182), (0.995, 3, 5.841),
+    (0.975, 5, 2.571), (0.995, 5, 4.032),
+    (0.975, 10, 2.228), (0.995, 10, 3.169),
+    (0.975, 30, 2.042),
+]
+
+
+@pytest.mark.parametrize("p, df, expected", T_TABLE)
+def test_t_quantile(p, df, expected):
+    # exact for df 1 and 2, an expansion from df 3 on
+    assert t_quantile(p, df) == pytest.approx(expected, rel=1e-4 if df <= 2 else 1e-2)
+
+
+def test_confidence_halfwidth_two_values():
+    # sample standard deviation sqrt(2) over sqrt(2) values, times t 12.706 at df 1
+    assert confidence_halfwidth([0.0, 2.0]) == pytest.approx(12.706, rel=1e-3)
+    assert confidence_halfwidth([1.0, float('nan')]) == float('inf')
+
+
+def search_sweep(**search):
+    return {'routerTypes': ['MANAGED_FLOOD'], 'repetitions': 2,
+            'search': dict({'variable': 'nrNodes', 'range': [3, 40], 'metric': 'collisionRate', 'above': 10}, **search)}
+
+
+def test_normalize_sweep_defaults():
+    spec = normalize_sweep(dict(search_sweep(), maxRepetitions=None), 'saturation')
+    assert spec['name'] == 'saturation'
+    assert spec['search']['tolerance'] == 1
+    assert spec['routerTypes'] == [Config.ROUTER_TYPE.MANAGED_FLOOD]
+    assert 'maxRepetitions' not in spec
+
+
+@pytest.mark.parametrize("spec", [
+    search_sweep(below=80),
+    search_sweep(metric='throughput'),
+    search_sweep(range=[3]),
+    search_sweep(tolerance=0),
+    dict(search_sweep(), ciTargets={'throughput': 1.0}),
+    {'routerTypes': ['MANAGED_FLOOD'], 'repetitions': 2},
+])
+def test_normalize_sweep_rejects(spec):
+    with pytest.raises(ValueError):
+        normalize_sweep(spec, 'invalid')
+
+
+def test_load_sweep(tmp_path):
+    path = tmp_path / 'hops.yaml'
+    path.write_text('routerTypes: [MANAGED_FLOOD]\nrepetitions: 2\nnumberOfNodes: [3, 5]\nparameters:\n  hopLimit: [3, 5]\n  PERIOD: 200000\n')
+    spec = load_sweep(str(path))
+    # named after the file, with router types resolved and the defaults filled in
+    assert spec['name'] == 'hops'
+    assert spec['routerTypes'] == [Config.ROUTER_TYPE.MANAGED_FLOOD]
+    assert spec['parameters'] == {'hopLimit': [3, 5], 'PERIOD': 200000}
+    assert spec['ciTargets'] == {} and spec['confidence'] == 0.95
+    path = tmp_path / 'other.json'
+    path.write_text(json.dumps({'name': 'named', 'routerTypes': ['MANAGED_FLOOD'], 'repetitions': 1, 'numberOfNodes': [3], 'ciTargets': {'reachability': 2}}))
+    spec = load_sweep(str(path))
+    assert spec['name'] == 'named' and spec['ciTargets'] == {'reachability': 2}
+    path.write_text(json.dumps({'routerTypes': ['MANAGED_FLOOD'], 'repetitions': 1, 'numberOfNodes': [3], 'parameters': {'NO_SUCH_SETTING': [1, 2]}}))
+    with pytest.raises(AttributeError):
+        load_sweep(str(path))
+
+
+def test_validate_search():
+    spec = {'parameters': {'hopLimit': [3, 5]}, 'search': {'variable': 'PERIOD', 'range': [30000, 300000], 'metric': 'reachability', 'below': 80}}
+    validate_search(spec, 'search')
+    assert spec['search']['tolerance'] == 1
+    for search, error in [({'variable': 'NO_SUCH_SETTING'}, AttributeError), ({'variable': 'hopLimit'}, ValueError), ({'above': 10}, ValueError),
+                          ({'range': [30000, 'max']}, ValueError), ({'steps': 5}, ValueError), ({'tolerance': -1}, ValueError)]:
+        with pytest.raises(error):
+            validate_search(dict(spec, search=dict(spec['search'], **search)), 'search')
+
+
+def test_parameter_grid():
+    # lists are swept over in order, with the last parameter changing fastest; single values are in every combination
+    assert parameter_grid({'hopLimit': [3, 5], 'PERIOD': 100000, 'MODEM': [2, 4]}) == [
+        {'hopLimit': 3, 'PERIOD': 100000, 'MODEM': 2}, {'hopLimit': 3, 'PERIOD': 100000, 'MODEM': 4},
+        {'hopLimit': 5, 'PERIOD': 100000, 'MODEM': 2}, {'hopLimit': 5, 'PERIOD': 100000, 'MODEM': 4},
+    ]
+    assert parameter_grid({'PERIOD': 100000}) == [{'PERIOD': 100000}]
+    assert parameter_grid({}) == [{}]
+
+
+def small_jobs(overrides=None, reps=(0, 1)):
+    point = (dict({'SIMTIME': 2 * 60000}, **(overrides or {})), 0, Config.ROUTER_TYPE.MANAGED_FLOOD, 4)
+    return point_jobs(point, reps, 'fast')
+
+
+@pytest.fixture
+def simulated(monkeypatch):
+    """ The jobs that run_jobs actually simulated. """
+    jobs = []
+    runJob = batch.run_job
+
+    def run_job(job, progress=None, showGraph=False):
+        jobs.append(job)
+        return runJob(job, progress, showGraph)
+
+    monkeypatch.setattr(batch, 'run_job', run_job)
+    return jobs
+
+
+def test_cache_hits_unchanged_jobs(tmp_path, simulated):
+    cache = ResultCache(str(tmp_path))
+    jobs = small_jobs()
+    first = run_jobs(jobs, cache=cache)
+    assert len(simulated) == 2
+    second = run_jobs(small_jobs(), cache=cache)
+    assert len(simulated) == 2
+    assert [record for record, _ in second] == [pytest.approx(record, nan_ok=True) for record, _ in first]
+    assert all(packetLog is None for _, packetLog in second)
+    # the engine is not part of the key
+    run_jobs([job._replace(engine='simpy') for job in jobs], cache=cache)
+    assert len(simulated) == 2
+
+
+def test_cache_misses_changed_jobs(tmp_path, simulated):
+    cache = ResultCache(str(tmp_path))
+    jobs = small_jobs()
+    run_jobs(jobs, cache=cache)
+    run_jobs(small_jobs({'hopLimit': 5}), cache=cache)
+    assert len(simulated) == 4
+    run_jobs([jobs[0]._replace(seed=jobs[0].seed + 1)], cache=cache)
+    assert len(simulated) == 5
+    run_jobs(jobs, cache=cache, force=True)
+    assert simulated[5:] == jobs
+
+
+def test_cache_misses_after_code_change(tmp_path, monkeypatch):
+    # a copy of lib/, so that a change to one of its files can be simulated
+    lib = tmp_path / 'lib'
+    shutil.copytree(os.path.dirname(batch.__file__), lib, ignore=shutil.ignore_patterns('__pycache__'))
+    monkeypatch.setattr(batch, '__file__', str(lib / 'batch.py'))
+    monkeypatch.setattr(batch, '_codeVersion', None)
+    job = small_jobs(reps=(0,))[0]
+    before = job_key(job)
+    with open(lib / 'phy.py', 'a') as file:
+        file.write('\n# changed\n')
+    monkeypatch.setattr(batch, '_codeVersion', None)
+    assert job_key(job) != before
+
+
+def test_parallel_jobs_match_serial():
+    # jobs of different cost, so that the longest-first pool starts and finishes them in another order
+    jobs = small_jobs(reps=(0,)) + small_jobs({'PERIOD': 30000}, reps=(1,)) + small_jobs({'SIMTIME': 4 * 60000}, reps=(0, 1))
+    assert sorted(jobs, key=batch.job_cost, reverse=True) != jobs
+    serial = run_jobs(jobs, nrJobs=1)
+    parallel = run_jobs(jobs, nrJobs=3)
+    for (serialRecord, serialLog), (parallelRecord, parallelLog) in zip(serial, parallel):
+        assert parallelRecord == pytest.approx(serialRecord, nan_ok=True, rel=0, abs=0)
+        assert parallelLog.table().keys() == serialLog.table().keys()
+        for name, column in serialLog.table().items():
+            assert parallelLog.table()[name].tolist() == column.tolist()
+
+
+def test_adaptive_sweep_resumes(tmp_path, monkeypatch, simulated):
+    # repetitions are added until the interval of the reachability is narrow enough, which takes a few rounds
+    spec = normalize_sweep({'routerTypes': ['MANAGED_FLOOD'], 'repetitions': 2, 'numberOfNodes': [4, 6], 'maxRepetitions': 6,
+                            'parameters': {'SIMTIME': 2 * 60000}, 'ciTargets': {'reachability': 0.5}}, 'adaptive')
+    complete, completeRepetitions = run_sweep(spec, 'fast', cache=ResultCache(str(tmp_path / 'complete')))
+    total = len(simulated)
+    assert total > 4
+    # interrupt a second sweep after three runs
+    runJob = batch.run_job
+
+    def interrupted(job, progress=None, showGraph=False):
+        if len(simulated) == total + 3:
+            raise KeyboardInterrupt
+        return runJob(job, progress, showGraph)
+
+    cache = ResultCache(str(tmp_path / 'resumed'))
+    monkeypatch.setattr(batch, 'run_job', interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        run_sweep(spec, 'fast', cache=cache)
+    monkeypatch.setattr(batch, 'run_job', runJob)
+    resumed, resumedRepetitions = run_sweep(spec, 'fast', cache=cache)
+    # only the runs that did not finish before are simulated, with the same results
+    assert len(simulated) == 2 * total
+    assert resumedRepetitions == completeRepetitions
+    assert resumed.keys() == complete.keys()
+    for key, (record, _) in complete.items():
+        assert resumed[key][0] == pytest.approx(record, nan_ok=True)
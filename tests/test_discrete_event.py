@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+from lib.batch import generate_positions, make_config, run_simulation
+from lib.config import Config
+from lib.node import MeshNode
+
+
+def run(nrNodes, seed, overrides):
+    conf = make_config(Config.ROUTER_TYPE.MANAGED_FLOOD, nrNodes, seed, 'fast', overrides)
+    record, _ = run_simulation(conf, generate_positions(conf, nrNodes, seed))
+    return record
+
+
+def test_default_delivers_to_every_node():
+    # asymmetric links and moving nodes, as in the default Config, with the results of delivering every packet to every node
+    record = run(25, 4, {})
+    assert (record['nrCollisions'], record['nrSensed'], record['nrReceived'], record['usefulPackets']) == (3247, 15022, 10597, 4874)
+
+
+def test_neighbor_delivery_asymmetric_links():
+    # delivering only to the nodes that can sense a packet handles same-time events in another
+    # order, so single runs may differ, but the metrics agree over several seeds
+    overrides = {'MODEL_ASYMMETRIC_LINKS': True, 'SIMTIME': 15 * 60000}
+    metrics = ('collisionRate', 'reachability', 'usefulness')
+    everyNode = []
+    neighbors = []
+    for seed in range(8):
+        everyNode.append([run(20, seed, dict(overrides, NEIGHBOR_DELIVERY=False))[metric] for metric in metrics])
+        neighbors.append([run(20, seed, dict(overrides, NEIGHBOR_DELIVERY=True))[metric] for metric in metrics])
+    everyNode = np.array(everyNode)
+    neighbors = np.array(neighbors)
+    assert np.abs(neighbors - everyNode).max() < 5
+    assert neighbors.mean(axis=0) == pytest.approx(everyNode.mean(axis=0), abs=1.5)
+
+
+def test_channel_idle_wakeup(monkeypatch):
+    # a node waiting for the channel wakes up once the last packet it detects has ended, never later
+    wakeups = []
+    released = MeshNode.channel_released
+
+    def check(self):
+        released(self)
+        if self.channelIdle is None:
+            wakeups.append(self.env.now)
+        for node in self.nodes:
+            if node.channelIdle is not None:
+                assert node.channelActivity.overlapping(self.env.now, includeEnding=True)
+
+    monkeypatch.setattr(MeshNode, 'channel_released', check)
+    metrics = ('collisionRate', 'reachability')
+    polling = []
+    idle = []
+    for seed in range(4):
+        polling.append([run(20, seed, {'PERIOD': 30000})[metric] for metric in metrics])
+        idle.append([run(20, seed, {'PERIOD': 30000, 'CHANNEL_IDLE_WAKEUP': True})[metric] for metric in metrics])
+    assert wakeups
+    assert np.mean(idle, axis=0) == pytest.approx(np.mean(polling, axis=0), abs=3)
@@ -0,0 +1,61 @@
+import pytest
+
+from lib.batch import generate_positions, make_config, run_simulation
+from lib.config import Config
+from lib.kernel import ENGINES, make_environment, make_resource, make_store
+
+
+def event_order(engine):
+    """ Times and order in which a few interacting processes run on an engine. """
+    env = make_environment(engine)
+    store = make_store(env)
+    resource = make_resource(env)
+    log = []
+
+    def producer(name, delay):
+        for i in range(3):
+            yield env.timeout(delay)
+            log.append((env.now, name, 'put', i))
+            yield store.put((name, i))
+
+    def consumer():
+        while True:
+            item = yield store.get()
+            log.append((env.now, 'consumer', 'got', item))
+            with resource.request() as request:
+                yield request
+                yield env.timeout(1)
+                log.append((env.now, 'consumer', 'done', item))
+
+    def waiter():
+        # timeouts that end at the same time are processed in the order they were scheduled
+        yield env.all_of([env.timeout(2), env.timeout(4)])
+        log.append((env.now, 'waiter', 'all', None))
+
+    env.process(producer('a', 2))
+    env.process(producer('b', 3))
+    env.process(consumer())
+    env.process(waiter())
+    env.run(until=20)
+    return log
+
+
+def test_event_order():
+    assert event_order('fast') == event_order('simpy')
+
+
+@pytest.mark.parametrize("overrides", [
+    {},
+    {'DMs': True},
+    {'CHANNEL_IDLE_WAKEUP': True, 'MOBILITY_ENGINE': True},
+])
+def test_engines_give_same_results(overrides):
+    # a small mesh with the same seed and positions on both engines
+    records = []
+    for engine in ENGINES:
+        conf = make_config(Config.ROUTER_TYPE.MANAGED_FLOOD, 8, 5, engine, dict({'SIMTIME': 15 * 60000, 'PERIOD': 30000}, **overrides))
+        record, packetLog = run_simulation(conf, generate_positions(conf, 8, 5))
+        records.append((record, {name: column.tolist() for name, column in packetLog.table().items()}))
+    (simpyRecord, simpyPackets), (fastRecord, fastPackets) = records
+    assert fastRecord == pytest.approx(simpyRecord, nan_ok=True, rel=0, abs=0)
+    assert fastPackets == simpyPackets
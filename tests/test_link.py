@@ -0,0 +1,80 @@
+import types
+
+import numpy as np
+import pytest
+
+from lib.config import Config
+from lib.link import LinkBudget
+from lib.phy import estimate_path_loss, modem_profile
+
+
+def make_links(nrNodes=30, seed=1):
+    conf = Config()
+    rng = np.random.default_rng(seed)
+    nodes = [types.SimpleNamespace(x=x, y=y, z=conf.HM, antennaGain=gain)
+             for x, y, gain in zip(rng.uniform(0, 6000, nrNodes), rng.uniform(0, 6000, nrNodes), rng.choice([0, 3], nrNodes))]
+    # asymmetric offsets, so that rows and columns differ
+    conf.LINK_OFFSET = {(tx, rx): rng.normal(0, 4) for tx in range(nrNodes) for rx in range(nrNodes) if tx != rx}
+    return conf, nodes, LinkBudget(conf, nodes)
+
+
+def rebuilt(conf, nodes):
+    links = LinkBudget(conf, nodes)
+    links.build()
+    return links
+
+
+def brute_force_neighbors(conf, nodes, txNodeId):
+    """ The nodes that sense and that detect a transmission by txNodeId, one pair at a time. """
+    profile = modem_profile(conf)
+    tx = nodes[txNodeId]
+    sensed, detected = [], []
+    for rxNodeId, rx in enumerate(nodes):
+        if rxNodeId == txNodeId:
+            continue
+        dist = np.sqrt((tx.x - rx.x) ** 2 + (tx.y - rx.y) ** 2 + (tx.z - rx.z) ** 2)
+        pathLoss = estimate_path_loss(conf, dist, conf.FREQ, tx.z, rx.z) + conf.LINK_OFFSET[(txNodeId, rxNodeId)]
+        rssi = conf.PTX + tx.antennaGain - pathLoss
+        if rssi >= profile.sensitivity:
+            sensed.append(rxNodeId)
+        if rssi >= profile.cadThreshold:
+            detected.append(rxNodeId)
+    return sensed, detected
+
+
+def test_dirty_update_matches_rebuild():
+    conf, nodes, links = make_links()
+    rng = np.random.default_rng(2)
+    links.row(0)
+    for _ in range(5):
+        # fewer than half of the nodes, so only their rows and columns are recomputed
+        for nodeid in rng.choice(len(nodes), 4, replace=False):
+            nodes[nodeid].x += rng.uniform(-2000, 2000)
+            nodes[nodeid].y += rng.uniform(-2000, 2000)
+            links.node_moved(nodeid)
+        links.row(0)
+        assert not links.dirty
+        full = rebuilt(conf, nodes)
+        for name in ('pathLoss', 'rssi', 'sensed', 'detected'):
+            np.testing.assert_array_equal(getattr(links, name), getattr(full, name))
+        for nodeid in range(len(nodes)):
+            np.testing.assert_array_equal(links.neighbors(nodeid), full.neighbors(nodeid))
+            np.testing.assert_array_equal(links.cad_neighbors(nodeid), full.cad_neighbors(nodeid))
+
+
+@pytest.mark.parametrize("batch", [False, True])
+def test_neighbor_caches_follow_moves(batch):
+    conf, nodes, links = make_links()
+    for nodeid in range(len(nodes)):
+        links.neighbors(nodeid)
+        links.cad_neighbors(nodeid)
+    # move one node from one corner to the other, so its own list and those of others change
+    nodes[7].x, nodes[7].y = 6000 - nodes[7].x, 6000 - nodes[7].y
+    if batch:
+        links.nodes_moved(np.array([7]))
+    else:
+        links.node_moved(7)
+    for nodeid in range(len(nodes)):
+        sensed, detected = brute_force_neighbors(conf, nodes, nodeid)
+        assert links.neighbors(nodeid).tolist() == sensed
+        assert links.cad_neighbors(nodeid).tolist() == detected
@@ -0,0 +1,19 @@
+import pytest
+
+from lib.batch import generate_positions, make_config, run_simulation
+from lib.config import Config
+
+
+def run(overrides):
+    conf = make_config(Config.ROUTER_TYPE.MANAGED_FLOOD, 10, 3, 'fast', dict({'SIMTIME': 10 * 60000, 'PERIOD': 30000}, **overrides))
+    record, _ = run_simulation(conf, generate_positions(conf, 10, 3))
+    return record
+
+
+@pytest.mark.parametrize("size, expiry", [(None, None), (4, None), (None, 60000), (2, 30000)])
+def test_summary_without_packet_log(size, expiry):
+    # the same statistics with and without the PacketLog, also when nodes forget sequence numbers
+    history = {'PACKET_HISTORY_SIZE': size, 'PACKET_HISTORY_EXPIRY': expiry}
+    withLog = run(dict(history, PACKET_LOG=True))
+    withoutLog = run(dict(history, PACKET_LOG=False))
+    assert withoutLog == pytest.approx(withLog, nan_ok=True)
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from lib.batch import generate_positions, make_config, run_simulation
+from lib.config import Config
+from lib.link import LinkBudget
+
+
+def movement_statistics(monkeypatch, engine):
+    """ Per moving node and minute: moves, interval mean and coefficient of variation, step length and net displacement in units of the speed. """
+    moves = []
+    nodeMoved = LinkBudget.node_moved
+    nodesMoved = LinkBudget.nodes_moved
+
+    def record(links, nodeid):
+        node = links.nodes[nodeid]
+        moves.append((nodeid, node.env.now, node.x, node.y, node.movementStepSize))
+
+    monkeypatch.setattr(LinkBudget, 'node_moved', lambda self, nodeid: record(self, nodeid) or nodeMoved(self, nodeid))
+    monkeypatch.setattr(LinkBudget, 'nodes_moved', lambda self, nodeids: [record(self, i) for i in nodeids.tolist()] and nodesMoved(self, nodeids))
+    rates, intervals, steps, displacements = [], [], [], []
+    for seed in range(3):
+        moves.clear()
+        overrides = {'MOBILITY_ENGINE': engine, 'APPROX_RATIO_NODES_MOVING': 1, 'SIMTIME': 60 * 60000, 'PERIOD': 10 * 60000}
+        conf = make_config(Config.ROUTER_TYPE.MANAGED_FLOOD, 30, seed, 'fast', overrides)
+        run_simulation(conf, generate_positions(conf, 30, seed))
+        for nodeid in set(move[0] for move in moves):
+            track = np.array([move[1:] for move in moves if move[0] == nodeid])
+            time, x, y, speed = track[:, 0], track[:, 1], track[:, 2], track[0, 3]
+            rates.append(len(track) / 60)
+            intervals.extend(np.diff(time) / conf.ONE_MIN_INTERVAL)
+            steps.extend(np.hypot(np.diff(x), np.diff(y)) / speed)
+            displacements.append(np.hypot(x[-1] - x[0], y[-1] - y[0]) / speed)
+    intervals = np.array(intervals)
+    return np.mean(rates), intervals.mean(), intervals.std() / intervals.mean(), np.mean(steps), np.mean(displacements)
+
+
+def test_engine_moves_like_move_node(monkeypatch):
+    # exponential intervals of a minute on average (coefficient of variation 1) and steps of up to the speed per move
+    perNode = movement_statistics(monkeypatch, False)
+    engine = movement_statistics(monkeypatch, True)
+    assert engine[:4] == pytest.approx(perNode[:4], abs=0.1)
+    assert engine[2] == pytest.approx(1, abs=0.1)
+    assert engine[4] == pytest.approx(perNode[4], rel=0.15)
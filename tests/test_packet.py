@@ -0,0 +1,130 @@
+import types
+
+import pytest
+
+from lib.batch import generate_positions, make_config, run_simulation
+from lib.config import Config
+from lib.link import LinkBudget
+from lib.packet import NODENUM_BROADCAST, MeshPacket, PacketRegistry
+
+
+def run(seed, overrides):
+    conf = make_config(Config.ROUTER_TYPE.MANAGED_FLOOD, 12, seed, 'fast', dict({'SIMTIME': 40 * 60000}, **overrides))
+    record, _ = run_simulation(conf, generate_positions(conf, 12, seed))
+    return record
+
+
+@pytest.mark.parametrize("overrides", [{}, {'DMs': True}, {'PACKET_LOG': False, 'DMs': True, 'PERIOD': 30000}])
+def test_dropping_packets_matches_retaining(monkeypatch, overrides):
+    # longer than the fact horizon, and with queues of minutes at PERIOD 30000, so facts expire while copies wait
+    registries = []
+    finish = PacketRegistry.finish
+    monkeypatch.setattr(PacketRegistry, 'FORGET_BATCH', 64)
+    monkeypatch.setattr(PacketRegistry, 'finish', lambda self: registries.append(self) or finish(self))
+    for seed in range(3):
+        retained = run(seed, dict(overrides, RETAIN_PACKETS=True))
+        dropped = run(seed, dict(overrides, RETAIN_PACKETS=False))
+        assert dropped == pytest.approx(retained, nan_ok=True)
+    for registry in registries[1::2]:
+        # the facts of the seqs that are off the air for long are forgotten
+        assert len(registry.retiredOrig) < max(registry.retiredOrig) / 2
+        if registry.metrics.log is None:
+            assert registry.metrics.base > 0
+
+
+def make_registry(retain=False, expiry=60000):
+    conf = Config()
+    nodes = [types.SimpleNamespace(x=500.0 * i, y=0.0, z=conf.HM, antennaGain=0, hopLimit=3) for i in range(4)]
+    return conf, PacketRegistry(LinkBudget(conf, nodes), retain=retain, expiry=expiry)
+
+
+def add_packet(conf, registry, origTxNodeId, txNodeId, seq, now, requestId=None, retransmissions=None):
+    packet = MeshPacket(conf, registry, origTxNodeId, NODENUM_BROADCAST, txNodeId, conf.PACKETLENGTH, seq, 0, True, requestId is not None, requestId, now)
+    if retransmissions is not None:
+        packet.retransmissions = retransmissions
+    registry.append(packet)
+    return packet
+
+
+def send(registry, packet, startTime):
+    packet.startTime = startTime
+    packet.endTime = startTime + packet.timeOnAir
+    registry.transmitted(packet)
+
+
+def test_registry_indexes():
+    conf, registry = make_registry()
+    original = add_packet(conf, registry, 0, 0, 1, 0)
+    rebroadcast = add_packet(conf, registry, 0, 1, 1, 10, retransmissions=1)
+    ack = add_packet(conf, registry, 2, 2, 2, 20, requestId=1)
+    other = add_packet(conf, registry, 3, 3, 3, 30)
+    assert registry.with_orig(0, 1) == [original, rebroadcast]
+    assert registry.with_orig(1, 1) == []
+    assert registry.with_tx(1, 1) == [rebroadcast]
+    assert registry.with_tx(0, 2) == []
+    assert registry.with_request(1) == [ack]
+    assert registry.has_request(1) and not registry.has_request(3)
+    assert registry.retransmission_state(0, 1, conf.maxRetransmission) == (1, False)
+    assert not registry.acknowledge_tx(3, 1)
+    assert registry.acknowledge_tx(1, 1)
+    assert rebroadcast.ackReceived and not original.ackReceived
+    assert registry.retransmission_state(0, 1, conf.maxRetransmission) == (1, True)
+    assert not registry.acknowledge_orig(2, 3)
+    assert registry.acknowledge_orig(3, 3)
+    assert other.ackReceived
+    registry.remove(other)
+    assert registry.with_orig(3, 3) == [] and len(registry) == 3
+
+
+def test_registry_answers_after_retiring():
+    conf, registry = make_registry()
+    original = add_packet(conf, registry, 0, 0, 1, 0)
+    rebroadcast = add_packet(conf, registry, 0, 1, 1, 0, retransmissions=1)
+    ack = add_packet(conf, registry, 2, 2, 2, 0, requestId=1)
+    send(registry, original, 0)
+    send(registry, rebroadcast, 5000)
+    send(registry, ack, 10000)
+    registry.retire(20000)
+    assert len(registry) == 0
+    assert registry.with_orig(0, 1) == [] and registry.with_tx(1, 1) == [] and registry.with_request(1) == []
+    # the facts of the retired packets still answer
+    assert registry.has_request(1) and not registry.has_request(2)
+    assert registry.retransmission_state(0, 1, conf.maxRetransmission) == (1, False)
+    assert registry.retransmission_state(3, 1, conf.maxRetransmission) == (conf.maxRetransmission, False)
+    assert registry.acknowledge_tx(1, 1) and not registry.acknowledge_tx(3, 1)
+    assert registry.retransmission_state(0, 1, conf.maxRetransmission) == (1, True)
+    assert registry.acknowledge_orig(0, 1) and not registry.acknowledge_orig(2, 1)
+    # a copy created within the horizon and still queued keeps the facts of its seq, and combines with them
+    retransmission = add_packet(conf, registry, 0, 0, 1, 50000, retransmissions=0)
+    registry.retire(200000)
+    assert registry.retransmission_state(0, 1, conf.maxRetransmission) == (0, True)
+    assert registry.has_request(1)
+    registry.remove(retransmission)
+    # once nothing of seq 1 is left and the horizon has passed, it is forgotten
+    registry.retire(300000)
+    assert not registry.has_request(1)
+    assert not registry.acknowledge_tx(1, 1)
+    assert registry.retransmission_state(0, 1, conf.maxRetransmission) == (conf.maxRetransmission, False)
+    assert not registry.retiredTimes and not registry.retiredOrig
+
+
+def test_retained_registry_keeps_packets():
+    conf, registry = make_registry(retain=True)
+    original = add_packet(conf, registry, 0, 0, 1, 0)
+    send(registry, original, 0)
+    registry.retire(300000)
+    assert registry.with_orig(0, 1) == [original]
+    assert registry.acknowledge_orig(0, 1) and original.ackReceived
+
+
+@pytest.mark.parametrize("overrides", [{}, {'DMs': True}, {'MODEL_ASYMMETRIC_LINKS': True, 'RETAIN_PACKETS': True}])
+def test_sparse_receivers_match_dense(overrides):
+    # per-receiver state only for the nodes that detect a packet, with the same records and packets
+    results = []
+    for sparse in (False, True):
+        conf = make_config(Config.ROUTER_TYPE.MANAGED_FLOOD, 20, 1, 'fast', dict(overrides, SPARSE_RECEIVERS=sparse, SIMTIME=15 * 60000))
+        record, packetLog = run_simulation(conf, generate_positions(conf, 20, 1))
+        results.append((record, {name: column.tolist() for name, column in packetLog.table().items()}))
+    (denseRecord, densePackets), (sparseRecord, sparsePackets) = results
+    assert sparseRecord == pytest.approx(denseRecord, nan_ok=True, rel=0, abs=0)
+    assert sparsePackets == densePackets
@@ -0,0 +1,96 @@
+import random
+
+import numpy as np
+import pytest
+
+from lib import phy
+from lib.common import calc_dist, find_random_position, search_radius
+from lib.config import Config
+from lib.spatial import SpatialGrid
+
+
+def brute_force(points, x, y, radius):
+    return sorted(key for key, (px, py) in points.items() if (px - x) ** 2 + (py - y) ** 2 <= radius ** 2)
+
+
+@pytest.mark.parametrize("radius", [40, 100, 250])
+def test_query_matches_brute_force(radius):
+    rng = np.random.default_rng(3)
+    grid = SpatialGrid(100)
+    points = {}
+    # random points, points on cell boundaries and corners, and negative coordinates
+    for key in range(300):
+        if key % 3 == 0:
+            x, y = 100 * int(rng.integers(-5, 6)), 100 * int(rng.integers(-5, 6))
+        else:
+            x, y = rng.uniform(-600, 600, 2).tolist()
+        points[key] = (x, y)
+        grid.insert(key, x, y)
+    centers = [(0, 0), (100, -200), (50, 50), (-300, 400)] + [tuple(rng.uniform(-600, 600, 2).tolist()) for _ in range(30)]
+    # points exactly at the radius count as within it
+    points[300] = (100 + radius, -200)
+    grid.insert(300, *points[300])
+    for x, y in centers:
+        assert sorted(grid.query(x, y, radius)) == brute_force(points, x, y, radius)
+    for key in range(0, 300, 7):
+        points[key] = (points[key][0] + 150, points[key][1] - 100 * (key % 3))
+        grid.move(key, *points[key])
+    for key in range(1, 300, 11):
+        del points[key]
+        grid.remove(key)
+    assert len(grid) == len(points)
+    for x, y in centers:
+        assert sorted(grid.query(x, y, radius)) == brute_force(points, x, y, radius)
+
+
+def find_random_position_scan(conf, nodes):
+    """ find_random_position as it checked every node before the grid. """
+    foundMin = True
+    foundMax = False
+    tries = 0
+    x = 0
+    y = 0
+    while not (foundMin and foundMax):
+        posx = random.random() * conf.XSIZE + conf.OX - conf.XSIZE / 2
+        posy = random.random() * conf.YSIZE + conf.OY - conf.YSIZE / 2
+        if len(nodes) > 0:
+            for n in nodes:
+                dist = calc_dist(n.x, posx, n.y, posy)
+                if dist < conf.MINDIST:
+                    foundMin = False
+                    break
+                if conf.PTX + 2 * conf.GL - phy.estimate_path_loss(conf, dist, conf.FREQ) >= phy.modem_profile(conf).sensitivity:
+                    foundMax = True
+            if foundMin and foundMax:
+                x = posx
+                y = posy
+        else:
+            x = posx
+            y = posy
+            foundMin = True
+            foundMax = True
+        tries += 1
+        if tries > 1000:
+            break
+    return max(-conf.XSIZE / 2, x), max(-conf.YSIZE / 2, y)
+
+
+class Point:
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+
+def test_find_random_position_matches_scan():
+    conf = Config()
+    grid = SpatialGrid(search_radius(conf, 2 * conf.GL))
+    nodes = []
+    for seed in range(40):
+        random.seed(seed)
+        expected = find_random_position_scan(conf, nodes)
+        random.seed(seed)
+        assert find_random_position(conf, nodes, grid) == expected
+        random.seed(seed)
+        assert find_random_position(conf, nodes) == expected
+        nodes.append(Point(*expected))
+        grid.insert(len(nodes) - 1, *expected)
@@ -0,0 +1,100 @@
+import collections
+import math
+import os
+import struct
+
+import numpy as np
+import pytest
+
+from lib.batch import generate_positions, make_config, run_simulation
+from lib.config import Config
+from lib.trace import (COLLIDED, EVENT_NAMES, GENERATED, HEADER_SIZE, MAGIC, RETRANSMITTED, RX_DECODED, RX_FAILED,
+                       RX_MISSED, RX_STARTED, TRACE_DTYPE, TX_CANCELLED, TX_STARTED, VERSION, TraceReader, TraceRecorder)
+
+Packet = collections.namedtuple('Packet', ['seq', 'txNodeId', 'origTxNodeId', 'hopLimit', 'isAck'])
+
+
+def write_trace(path, chunkRecords=4):
+    """ Ten records at times 0, 10, ..., 90, flushed in chunks of chunkRecords. """
+    recorder = TraceRecorder(str(path), chunkRecords)
+    for i in range(10):
+        packet = Packet(seq=100 + i // 2, txNodeId=i % 3, origTxNodeId=1, hopLimit=3 - i % 4, isAck=i == 9)
+        rssi = math.nan if i % 5 == 0 else -100.5 - i
+        recorder.record(10.0 * i, RX_DECODED if i % 2 else TX_STARTED, i % 4, packet, rssi)
+    recorder.close()
+    return recorder
+
+
+def test_layout(tmp_path):
+    path = tmp_path / 'trace.bin'
+    recorder = write_trace(path)
+    assert TRACE_DTYPE.itemsize == 36
+    assert recorder.count == 10
+    assert os.path.getsize(path) == HEADER_SIZE + 10 * 36
+    with open(path, 'rb') as file:
+        header = file.read(HEADER_SIZE)
+    assert header == struct.pack('<8sII', MAGIC, VERSION, 36).ljust(64, b'\0')
+    # the event codes are part of the file format
+    assert (GENERATED, RETRANSMITTED, TX_STARTED, TX_CANCELLED, RX_STARTED, RX_MISSED, RX_DECODED, RX_FAILED, COLLIDED) == tuple(range(1, 10))
+    assert sorted(EVENT_NAMES) == list(range(1, 10))
+
+
+def test_round_trip(tmp_path):
+    path = tmp_path / 'trace.bin'
+    write_trace(path)
+    trace = TraceReader(str(path))
+    assert len(trace) == 10
+    records = trace.between()
+    assert records['time'].tolist() == [10.0 * i for i in range(10)]
+    assert records['seq'].tolist() == [100 + i // 2 for i in range(10)]
+    assert records['node'].tolist() == [i % 4 for i in range(10)]
+    assert records['txNodeId'].tolist() == [i % 3 for i in range(10)]
+    assert records['origTxNodeId'].tolist() == [1] * 10
+    assert records['hopLimit'].tolist() == [3 - i % 4 for i in range(10)]
+    assert records['event'].tolist() == [RX_DECODED if i % 2 else TX_STARTED for i in range(10)]
+    assert records['isAck'].tolist() == [0] * 9 + [1]
+    assert np.isnan(records['rssi'][[0, 5]]).all()
+    assert records['rssi'][1] == pytest.approx(-101.5)
+
+
+def test_selections(tmp_path):
+    path = tmp_path / 'trace.bin'
+    write_trace(path)
+    trace = TraceReader(str(path))
+    # start inclusive, end exclusive
+    assert trace.between(20, 50)['time'].tolist() == [20.0, 30.0, 40.0]
+    assert trace.between(start=85)['time'].tolist() == [90.0]
+    assert trace.select(event=RX_DECODED)['time'].tolist() == [10.0, 30.0, 50.0, 70.0, 90.0]
+    assert trace.select(start=0, end=60, node=[1, 2], event=RX_DECODED)['time'].tolist() == [10.0, 50.0]
+    assert trace.select(seq=102, txNodeId=1)['time'].tolist() == [40.0]
+    assert len(trace.select(node=7)) == 0
+
+
+def test_rejects_other_files(tmp_path):
+    path = tmp_path / 'other.bin'
+    path.write_bytes(b'\0' * HEADER_SIZE)
+    with pytest.raises(ValueError):
+        TraceReader(str(path))
+    path.write_bytes(struct.pack('<8sII', MAGIC, VERSION + 1, 36).ljust(HEADER_SIZE, b'\0'))
+    with pytest.raises(ValueError):
+        TraceReader(str(path))
+
+
+def test_empty_trace(tmp_path):
+    path = tmp_path / 'trace.bin'
+    TraceRecorder(str(path)).close()
+    trace = TraceReader(str(path))
+    assert len(trace) == 0
+    assert len(trace.select(event=RX_DECODED)) == 0
+
+
+def test_simulation_trace(tmp_path):
+    # a traced run has one RX_DECODED record per reception and one GENERATED record per message
+    conf = make_config(Config.ROUTER_TYPE.MANAGED_FLOOD, 8, 5, 'fast', {'SIMTIME': 15 * 60000, 'PERIOD': 30000})
+    path = str(tmp_path / 'trace.bin')
+    record, _ = run_simulation(conf, generate_positions(conf, 8, 5), path)
+    trace = TraceReader(path)
+    times = trace.between()['time']
+    assert (np.diff(times) >= 0).all()
+    assert len(trace.select(event=RX_DECODED)) == record['nrReceived']
+    assert len(trace.select(event=GENERATED)) == record['nrMessages']